@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+'''Scaling benchmarks for the list, commit, apply and boot paths.
+
+A synthetic sysroot is built in a temporary directory, holding a real OSTree
+repository with N generated sysext commits, an os-release file and a stub
+systemd-sysext which answers with canned JSON. Privileged operations run in
+a forked child as usual, but without entering the sysroot, and mounts are
+stubbed out, so that no root privileges are needed.
+
+Usage: bench_scaling.py [--sizes 10,100,1000] [--repeat 3] [--output FILE]
+
+Results are written as JSON, one record per (benchmark, size).
+'''
+import os
+import sys
+import gi
+import json
+import shutil
+import argparse
+import statistics
+
+gi.require_version("OSTree", "1.0")
+
+from gi.repository          import OSTree, Gio
+from pathlib                import Path
+from tempfile               import mkdtemp
+from time                   import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ostree_sysext          import sandbox, plugin, systemd, extensions, boot, deployment
+from ostree_sysext          import repo as sysext_repo
+from ostree_sysext.repo     import ExtensionIndex, RepoExtension, open_system_repo, find_sysext_refs
+from ostree_sysext.deployment import DeploymentSet
+from ostree_sysext.environment import list_sysexts
+
+OSNAME = 'bench'
+
+SYSEXT_STUB = '''#!/bin/sh
+case "$2" in
+    status) cat "{root}/bench/status.json" ;;
+    list)   cat "{root}/bench/list.json" ;;
+    *)      echo "[]" ;;
+esac
+'''
+
+
+class FakeDeployment:
+    '''Stands in for OSTree.Deployment, which cannot be constructed without
+    a real sysroot.
+    '''
+    def get_osname(self):
+        return OSNAME
+
+    def get_csum(self):
+        return '0' * 64
+
+    def get_deployserial(self):
+        return 0
+
+
+def make_sysroot(n: int) -> Path:
+    '''Create a sysroot with n sysext commits pinned in its repository.
+    '''
+    root = Path(mkdtemp(prefix=f"ostree-sysext-bench-{n}-"))
+    root.joinpath('etc').mkdir()
+    root.joinpath('etc', 'os-release').write_text(f'ID={OSNAME}\nVERSION_ID=1\n')
+    root.joinpath('ostree', 'repo').mkdir(parents=True)
+    root.joinpath('bench', 'bin').mkdir(parents=True)
+
+    repo = OSTree.Repo.new(Gio.File.new_for_path(str(root.joinpath('ostree', 'repo'))))
+    repo.create(OSTree.RepoMode.BARE_USER_ONLY, None)
+    src = Path(mkdtemp(prefix="ostree-sysext-bench-src-"))
+    repo.prepare_transaction()
+    for i in range(n):
+        id = f'bench-{i}'
+        shutil.rmtree(src)
+        rel = src.joinpath('usr', 'lib', 'extension-release.d')
+        rel.mkdir(parents=True)
+        rel.joinpath(f'extension-release.{id}').write_text(f'ID=_any\nNAME=Benchmark {i}\n')
+        share = src.joinpath('usr', 'share', id)
+        share.mkdir(parents=True)
+        for f in range(8):
+            share.joinpath(f'file{f}').write_text(f'{id} {f}\n' * 64)
+
+        mtree = OSTree.MutableTree()
+        repo.write_directory_to_mtree(Gio.File.new_for_path(str(src)), mtree, None)
+        ok, mr = repo.write_mtree(mtree)
+        ok, commit = repo.write_commit(None, id, None, None, mr)
+        repo.transaction_set_ref(None, f'ostree/extension/{id}/0', commit)
+    repo.commit_transaction()
+    shutil.rmtree(src)
+
+    # Half of the extensions are reported as staged and merged
+    ids = [f'bench-{i}' for i in range(0, n, 2)]
+    root.joinpath('bench', 'status.json').write_text(json.dumps(
+        [{ 'hierarchy': '/usr', 'extensions': ids or 'none' }]))
+    root.joinpath('bench', 'list.json').write_text(json.dumps(
+        [{ 'name': id, 'path': f'/run/extensions/{id}' } for id in ids]))
+    stub = root.joinpath('bench', 'bin', 'systemd-sysext')
+    stub.write_text(SYSEXT_STUB.format(root=root))
+    stub.chmod(0o755)
+    return root
+
+def isolate(root: Path):
+    '''Point every absolute path and privileged operation at the sysroot.
+    '''
+    os.chdir(root)
+    os.environ['PATH'] = f"{root.joinpath('bench', 'bin')}:{os.environ['PATH']}"
+    run = root.joinpath('bench', 'run')
+    sandbox._enter_sysroot = lambda: None
+    sandbox.load_composefs = lambda: None
+    plugin._import_plugins = lambda plugpath: iter(())
+    extensions.APPLIED_STATE_PATH = run.joinpath('ostree', '.private', 'applied.json')
+    extensions.Extension.DEPLOY_PATH = run.joinpath('extensions')
+    DeploymentSet.DEPLOY_PATH = run.joinpath('ostree', 'extensions')
+    boot.DEPLOY_PATH = DeploymentSet.DEPLOY_PATH
+    for mod in (sysext_repo, deployment, boot):
+        mod.COMPOSEFS_MOUNTS = run.joinpath('ostree', '.private', 'mounts')
+    systemd.invalidate_system_state()
+
+def reset_run(root: Path):
+    shutil.rmtree(root.joinpath('bench', 'run'), ignore_errors=True)
+
+def clear_index(repo: OSTree.Repo):
+    Path(repo.get_path().get_path(), ExtensionIndex.INDEX_PATH).unlink(missing_ok=True)
+
+def timed(fn, repeat: int, setup = None) -> list[float]:
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        fn()
+        runs.append(perf_counter() - start)
+    return runs
+
+def run_size(n: int, repeat: int) -> list[dict]:
+    root = make_sysroot(n)
+    cwd = os.getcwd()
+    results = []
+
+    def record(name: str, runs: list[float]):
+        results.append({ 'benchmark': name, 'n': n, 'repeat': len(runs),
+                         'min': min(runs), 'median': statistics.median(runs),
+                         'max': max(runs) })
+        print(f"{name:<24} n={n:<6} min={min(runs):.4f}s median={statistics.median(runs):.4f}s",
+              file=sys.stderr)
+
+    try:
+        isolate(root)
+        repo = open_system_repo(Path('ostree'))
+        dep = FakeDeployment()
+
+        record('find_sysext_refs.cold',
+               timed(lambda: list(find_sysext_refs(repo)), repeat, lambda: clear_index(repo)))
+        record('find_sysext_refs.warm',
+               timed(lambda: list(find_sysext_refs(repo)), repeat))
+        record('list_sysexts',
+               timed(list_sysexts, repeat, systemd.invalidate_system_state))
+
+        index = ExtensionIndex(repo)
+        exts = [RepoExtension(repo, ref, index) for ref in find_sysext_refs(repo, index=index)]
+        # The first commit also checks out every extension, and later ones
+        # find the same set by its content key
+        record('DeploymentSet.commit',
+               timed(lambda: DeploymentSet(repo, root=dep, exts=exts).commit(), 1))
+        record('DeploymentSet.commit.reuse',
+               timed(lambda: DeploymentSet(repo, root=dep, exts=exts).commit(), repeat))
+
+        ref = DeploymentSet(repo, root=dep, exts=exts).commit()
+        record('DeploymentSet.apply',
+               timed(lambda: DeploymentSet(repo, ref, root=dep).apply(syslink=False),
+                     repeat, lambda: reset_run(root)))
+        record('DeploymentSet.apply.noop',
+               timed(lambda: DeploymentSet(repo, ref, root=dep).apply(syslink=False), repeat))
+
+        dep_path = root.joinpath(DeploymentSet(repo, ref, root=dep)._deploy_space(), f'{ref}.0')
+        boot.find_deployment_path = lambda: dep_path
+        record('boot.get_deployment',
+               timed(lambda: boot.get_deployment(root, dep), repeat))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Scaling benchmarks for ostree-sysext")
+    ap.add_argument('--sizes', default='10,100,1000',
+                    help="comma-separated numbers of generated extensions")
+    ap.add_argument('--repeat', type=int, default=3, help="runs per benchmark")
+    ap.add_argument('--output', help="write JSON results to this file instead of stdout")
+    args = ap.parse_args()
+
+    results = []
+    for n in [int(s) for s in args.sizes.split(',')]:
+        results += run_size(n, args.repeat)
+
+    report = { 'python': sys.version.split()[0], 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+    main()
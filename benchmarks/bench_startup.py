@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''Startup-time benchmark for the command line entry point.
+
+Each scenario imports what its command needs in a fresh interpreter, and
+is timed over several runs. The benchmark fails if the median import time
+of a scenario exceeds its threshold, or if a module which a scenario must
+not pull in was imported.
+
+Usage: bench_startup.py [--repeat 10] [--scale 1.0] [--output FILE]
+
+Results are written as JSON, one record per scenario.
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from pathlib                import Path
+from time                   import perf_counter
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# name: (statement, threshold in seconds, modules which must not be imported)
+SCENARIOS = {
+    'cli': ("from ostree_sysext.cli import main_fixed_for_ostree",
+            0.150, ['rich', 'pydbus', 'gi', 'dotenv']),
+    'early-boot': ("from ostree_sysext.cli import main_fixed_for_ostree; "
+                   "from ostree_sysext.boot import boot_main",
+                   0.150, ['rich', 'pydbus', 'gi', 'dotenv']),
+}
+
+CHILD = '''
+import sys, json
+from time import perf_counter
+start = perf_counter()
+{statement}
+end = perf_counter()
+print(json.dumps({{ 'import': end - start,
+                    'loaded': [m for m in {forbidden!r} if m in sys.modules] }}))
+'''
+
+
+def run_once(statement: str, forbidden: list[str]) -> dict:
+    start = perf_counter()
+    r = subprocess.run([sys.executable, '-c', CHILD.format(statement=statement, forbidden=forbidden)],
+                       cwd=REPO_ROOT, capture_output=True, text=True)
+    wall = perf_counter() - start
+    if r.returncode != 0:
+        raise RuntimeError(r.stderr.strip())
+    res = json.loads(r.stdout)
+    res['wall'] = wall
+    return res
+
+def run_scenario(name: str, repeat: int, scale: float) -> dict:
+    statement, threshold, forbidden = SCENARIOS[name]
+    run_once(statement, forbidden)  # Populate bytecode caches
+    runs = [run_once(statement, forbidden) for _ in range(repeat)]
+    imports = [r['import'] for r in runs]
+    loaded = sorted(set(m for r in runs for m in r['loaded']))
+    median = statistics.median(imports)
+    return { 'scenario':  name,
+             'repeat':    repeat,
+             'min':       min(imports),
+             'median':    median,
+             'wall':      statistics.median([r['wall'] for r in runs]),
+             'threshold': threshold * scale,
+             'loaded':    loaded,
+             'ok':        median <= threshold * scale and len(loaded) == 0 }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Startup-time benchmark for ostree-sysext")
+    ap.add_argument('--repeat', type=int, default=10, help="runs per scenario")
+    ap.add_argument('--scale', type=float, default=1.0,
+                    help="multiply all thresholds, for slower machines")
+    ap.add_argument('--output', help="write JSON results to this file instead of stdout")
+    args = ap.parse_args()
+
+    results = []
+    for name in SCENARIOS.keys():
+        res = run_scenario(name, args.repeat, args.scale)
+        results.append(res)
+        print(f"{name:<12} median={res['median'] * 1e3:.1f}ms "
+              f"threshold={res['threshold'] * 1e3:.1f}ms "
+              f"{'ok' if res['ok'] else 'FAILED'}"
+              + (f" (imported {', '.join(res['loaded'])})" if res['loaded'] else ""),
+              file=sys.stderr)
+
+    report = { 'python': sys.version.split()[0], 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == '__main__':
+    main()
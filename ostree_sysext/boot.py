@@ -1,30 +1,117 @@
 import os
+import json
 
 from pathlib                import Path
-from gi.repository          import OSTree, Gio
+from logging                import error
 
-from .deployment            import DeploymentSet
-from .repo                  import open_system_repo
+from .extensions            import Extension, write_applied
+from .sandbox               import MountExecutor, COMPOSEFS_MOUNTS
 
-def get_deployment() -> DeploymentSet:
-    dep_path = ""
-    repo = open_system_repo('/sysroot/ostree')
+# Only the fallback path needs GObject-introspection and the repository,
+# so early-boot with a boot manifest does not import them.
+
+DEPLOY_PATH = Path('/','run','ostree','extensions')
+BOOT_MANIFEST = Path('state', 'ostree-sysext', 'boot.json')
+
+def _cmdline_arg(cmdl: list[str], key: str) -> str:
+    args = list(filter(lambda s: s.startswith(f"{key}="), cmdl))
+    if len(args) == 1:
+        return args[0].removeprefix(f"{key}=")
+    return None
+
+def find_deployment_path() -> Path:
+    '''Locate the deployment set checkout for the booted deployment, using
+    the kernel command line only. Returns None if it cannot be found.
+    '''
     with open('/proc/cmdline', 'r') as cmdf:
-        cmdl = cmdf.read().split(' ')
-        osys = list(filter(lambda s: s.startswith("ostree-sysext="), cmdl))
-        if len(osys) == 1:
-            dep_path = Path(osys[0].removeprefix("ostree-sysext="))
-    if dep_path == "":
+        cmdl = cmdf.read().split()
+    osys = _cmdline_arg(cmdl, "ostree-sysext")
+    if osys is not None:
+        return Path(osys)
+
+    ostree = _cmdline_arg(cmdl, "ostree")
+    if ostree is None:
+        return None
+    # ostree= points to a boot symlink which resolves to the deployment root
+    dx_path = Path(f"{Path('/', ostree.lstrip('/')).resolve()}.extensions")
+    if not dx_path.is_symlink():
+        return None
+    return Path(dx_path.parent, dx_path.readlink())
+
+def apply_manifest(dep_path: Path) -> bool:
+    '''Mount a deployment set from its boot manifest.
+    Returns False, without touching anything, if the manifest is missing or
+    refers to checkouts which do not exist yet.
+    '''
+    try:
+        with dep_path.joinpath(BOOT_MANIFEST).open() as f:
+            exts = json.load(f)['extensions']
+    except (OSError, ValueError, KeyError):
+        return False
+    for ext in exts:
+        if not Path(ext['checkout']).exists():
+            return False
+
+    # Same layout as DeploymentSet.apply(): images are mounted once per
+    # commit, and linked to from their deployment path
+    links = { DEPLOY_PATH: dep_path }
+    errors = {}
+    with MountExecutor() as mounts:
+        if dep_path.joinpath('.ostree.cfs').exists():
+            links[DEPLOY_PATH] = COMPOSEFS_MOUNTS.joinpath(dep_path.name)
+            links[DEPLOY_PATH].mkdir(parents=True, exist_ok=True)
+            mounts.submit('', dep_path.joinpath('.ostree.cfs'), links[DEPLOY_PATH])
+
+        for ext in exts:
+            dest = Extension.DEPLOY_PATH.joinpath(ext['id'])
+            links[dest] = Path(ext['checkout'])
+            if ext['composefs'] is not None and Path(ext['composefs']).exists():
+                verity = ext['verity'].encode() if ext['verity'] is not None else None
+                links[dest] = COMPOSEFS_MOUNTS.joinpath(links[dest].name)
+                links[dest].mkdir(parents=True, exist_ok=True)
+                mounts.submit(ext['id'], Path(ext['composefs']), links[dest], verity)
+        errors = mounts.wait()
+
+    if '' in errors:
+        error(f"Could not mount deployment set: {errors.pop('')}")
+        links.pop(DEPLOY_PATH)
+    for id, e in errors.items():
+        error(f"Could not deploy extension '{id}': {e}")
+        links.pop(Extension.DEPLOY_PATH.joinpath(id))
+    DEPLOY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    Extension.DEPLOY_PATH.mkdir(parents=True, exist_ok=True)
+    for dest, target in links.items():
+        os.symlink(str(target), str(dest))
+    write_applied(dep_path.name[:-2], { ext['id']: ext['commit'] for ext in exts
+                                        if ext['id'] not in errors })
+    if len(errors) > 0:
+        raise OSError(f"{len(errors)} extensions could not be deployed")
+    return True
+
+
+def get_deployment(sysroot: Path = Path('/', 'sysroot'), root = None):
+    '''Construct the DeploymentSet for the booted deployment, or for the given
+    root deployment.
+    '''
+    from gi.repository      import OSTree
+    from .deployment        import DeploymentSet
+    from .repo              import open_system_repo
+
+    repo = open_system_repo(sysroot.joinpath('ostree'))
+    dep_path = find_deployment_path()
+    if dep_path is None:
         sr = OSTree.Sysroot()
         sr.load()
         dep = sr.get_booted_deployment()
         dx_path = Path('/', f"{sr.get_deployment_dirpath(dep)}.extensions")
         dep_path = Path(dx_path.parent, dx_path.readlink())
 
-    return DeploymentSet(repo, dep_path.name[:-2])
-
+    return DeploymentSet(repo, dep_path.name[:-2], root=root)
 
 
 def boot_main():
+    dep_path = find_deployment_path()
+    if dep_path is not None and apply_manifest(dep_path):
+        return
     dep = get_deployment()
     dep.apply(syslink=False)
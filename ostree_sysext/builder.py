@@ -4,13 +4,17 @@ import importlib
 
 from enum                   import Enum
 from logging                import warn, error
-from gi.repository          import OSTree
+from gi.repository          import OSTree, GLib
 from base64                 import b64encode
 from random                 import randbytes
+from typing                 import Callable
+from pathlib                import Path
 
-from .extensions            import Extension, CompatVote, UpdateState, TransactionType
+from .extensions            import Extension, CompatVote, UpdateState
 from .sandbox               import edit_sandbox, edit_sysroot
-from .repo                  import RepoExtension, commit_dir
+from .repo                  import RepoExtension, SysrootTransaction, pull_refs
+
+BUILDERS_PATH = Path('/', 'usr', 'lib', 'ostree-sysext', 'builders')
 
 
 def check_update(builder: str, root: OSTree.Deployment, ext: RepoExtension,
@@ -19,12 +23,16 @@ def check_update(builder: str, root: OSTree.Deployment, ext: RepoExtension,
     Given a deployment root, and an extension, determine if updates are
     available and feasible for the given extension.
     '''
-    mod = find_builder(Path('/usr/lib/ostree-sysext/builders'), builder)
-    randid = b64encode(randbytes(9)).decode()
-    up = Path('/', 'tmp', 'ostree-sysext-{randid}')
+    return _check_update(find_builder(BUILDERS_PATH, builder), root, ext, force)
+
+def _check_update(mod, root: OSTree.Deployment, ext: RepoExtension,
+                  force=False) -> tuple[UpdateState, str]:
+    randid = b64encode(randbytes(9), b'-_').decode()
+    up = Path('/', 'tmp', f'ostree-sysext-{randid}')
+    context = ext.build_context
     res, msg = _call_sandbox(lambda: mod.check_update(root, ext, context), root, up)
 
-    return res, f"{builder}: {msg}"
+    return res, f"{mod.__name__}: {msg}"
 
 def build_extension(repo: OSTree.Repo, builder: str, root: OSTree.Deployment,
                     context: dict, force=False) -> tuple[CompatVote, str]:
@@ -32,8 +40,12 @@ def build_extension(repo: OSTree.Repo, builder: str, root: OSTree.Deployment,
     Given a deployment root and a build context, build and commit a system
     extension. The build context is a freeform dict.
     '''
-    mod = find_builder(Path('/usr/lib/ostree-sysext/builders'), builder)
-    randid = b64encode(randbytes(9)).decode()
+    return _build_extension(repo, find_builder(BUILDERS_PATH, builder), root, context, force)
+
+def _build_extension(repo: OSTree.Repo, mod, root: OSTree.Deployment,
+                     context: dict, force=False) -> tuple[CompatVote, str]:
+    builder = mod.__name__
+    randid = b64encode(randbytes(9), b'-_').decode()
     tgt = Path('/', 'var', 'tmp', 'ostree-sysext', f'build-{randid}')
     res, msg = _call_sandbox(lambda: mod.build_extension(root, context), root, tgt)
     if res == CompatVote.WARN and force:
@@ -42,10 +54,73 @@ def build_extension(repo: OSTree.Repo, builder: str, root: OSTree.Deployment,
         return res, f"{builder}: {msg}"
 
     meta = { 'ostree-sysext.builder': builder, 'ostree-sysext.build-context': context }
-    err, ref = edit_sysroot(lambda: (0, commit_dir(repo, tgt, meta=meta)))
+    tx = SysrootTransaction(repo)
+    tx.commit(tgt, meta=meta)
+    ref, = tx.run()
+    return CompatVote.APPROVE, ref
+
+def has_batch_hooks(mod) -> bool:
+    '''Whether a builder module handles whole batches of extensions at once,
+    through check_updates() and build_extensions() hooks.
+    build_extensions() returns the (remote, ref) to pull for each context,
+    and the pulls are performed by ostree-sysext.
+    '''
+    return hasattr(mod, 'check_updates') and hasattr(mod, 'build_extensions')
+
+def check_updates(mod, root: OSTree.Deployment, exts: list[RepoExtension],
+                  force=False) -> list[tuple[UpdateState, str]]:
+    '''Check for updates of several extensions made by the same builder,
+    given its module from find_builder(). Builders with batch hooks are
+    called once, in a single sandbox.
+    Safe to call from worker threads, as no builder is imported.
+    '''
+    builder = mod.__name__
+    if not has_batch_hooks(mod):
+        return [_check_update(mod, root, ext, force) for ext in exts]
+    randid = b64encode(randbytes(9), b'-_').decode()
+    up = Path('/', 'tmp', f'ostree-sysext-{randid}')
+    contexts = [ext.build_context for ext in exts]
+    res = _call_sandbox(lambda: mod.check_updates(root, exts, contexts), root, up)
+    return [(r, f"{builder}: {msg}") for r, msg in res]
+
+def build_extensions(repo: OSTree.Repo, mod, root: OSTree.Deployment,
+                     contexts: list[dict], force=False) -> list[tuple[CompatVote, str]]:
+    '''Build several extensions made by the same builder, given its module
+    from find_builder().
+    Builders with batch hooks name the remote refs to pull from their
+    sandbox, and all of them are then pulled in a single privileged call,
+    with one pull per remote.
+    '''
+    builder = mod.__name__
+    if not has_batch_hooks(mod):
+        return [_build_extension(repo, mod, root, ctx, force) for ctx in contexts]
+    randid = b64encode(randbytes(9), b'-_').decode()
+    up = Path('/', 'tmp', f'ostree-sysext-{randid}')
+    specs = [ (str(remote), str(ref)) for remote, ref in
+              _call_sandbox(lambda: mod.build_extensions(root, contexts), root, up) ]
+    if len(specs) != len(contexts):
+        raise ValueError(f"Builder '{builder}' returned {len(specs)} refs for {len(contexts)} extensions")
+    by_remote = {}
+    for remote, ref in specs:
+        by_remote.setdefault(remote, []).append(ref)
+
+    def pull():
+        wr = OSTree.Repo.new(repo.get_path())
+        wr.open()
+        res = {}
+        for remote, refs in by_remote.items():
+            try:
+                for ref, commit in pull_refs(wr, remote, refs).items():
+                    res[(remote, ref)] = (CompatVote.APPROVE, commit)
+            except GLib.Error as e:
+                for ref in refs:
+                    res[(remote, ref)] = (CompatVote.VETO, f"{builder}: {e.message}")
+        return 0, [res[spec] for spec in specs]
+
+    err, res = edit_sysroot(pull)
     if err:
         raise OSError(err)
-    return CompatVote.APPROVE, ref
+    return res
 
 def _call_sandbox(fn: Callable, root: OSTree.Deployment, \
                   upper: Path):
@@ -55,13 +130,15 @@ def _call_sandbox(fn: Callable, root: OSTree.Deployment, \
     binds = {Path('/', 'sysroot'): Path('/', 'sysroot')}
 
     work = upper.parent.joinpath(f'.work-{upper.name}')
+    upper.mkdir(parents=True, exist_ok=True)
+    work.mkdir(parents=True, exist_ok=True)
     return edit_sandbox(fn, layers, upper=upper, work=work, binds=binds)
 
 def find_builder(plugpath: str, name: str):
     oldpath = sys.path.copy()
     mymod = None
 
-    sys.path.insert(0, plugpath)
+    sys.path.insert(0, str(plugpath))
     try:
         importlib.import_module(name)
         mymod = sys.modules[name]
@@ -74,7 +151,7 @@ def find_builder(plugpath: str, name: str):
 def list_builders(plugpath: str):
     oldpath = sys.path.copy()
 
-    sys.path.insert(0, plugpath)
+    sys.path.insert(0, str(plugpath))
     for mod in pkgutil.iter_modules([plugpath]):
         importlib.import_module(mod.name)
         realmod = sys.modules[mod.name]
@@ -4,16 +4,16 @@ import sys
 import logging
 import functools
 
+from pathlib            import Path
 from click_option_group import OptionGroup
-from rich.console       import Console
-from rich.logging       import RichHandler
 
 from ..                 import __version__
-from .commands          import list_command, deploy, add_remove, mutate
-from ..dbus             import dbus_main
-from ..boot             import boot_main
+from ..trace            import enable_tracing, span
 
-cons = Console()
+# Command modules, rich, GObject-introspection and pydbus are only imported
+# by the commands which need them, so that startup stays cheap.
+
+cons = None
 common_group = OptionGroup("Common options for ostree-sysext")
 
 def _use_common_group(fn):
@@ -23,22 +23,57 @@ def _use_common_group(fn):
         return fn(*args, **kwargs)
     return wrapper
 
+def _console():
+    '''Return the shared rich Console, creating it on first use.
+    '''
+    global cons
+    if cons is None:
+        from rich.console import Console
+        cons = Console()
+    return cons
+
+def _report_profile(mode: str, outdir: str):
+    from rich.console import Console
+    tracer = enable_tracing()
+    Console(stderr=True).print(tracer.tree(), markup=False, highlight=False)
+    if mode == 'json':
+        path = Path(outdir, f'ostree-sysext-{os.getpid()}.trace.json')
+        tracer.write_chrome_trace(path)
+        logging.info(f"Wrote Chrome trace to {path}")
+
 # For some reason, OSTree sends our own subcommand name when calling,
 # drop it before entering click logic.
 def main_fixed_for_ostree():
     if len(sys.argv) > 1 and sys.argv[1] == 'sysext':
         sys.argv = sys.argv[1:]
         sys.argv[0] = 'ostree sysext'
+    if sys.argv[1:] == ['early-boot']:
+        return _early_boot_main()
+    # click would take the subcommand as the value of a bare --profile
+    sys.argv = [ '--profile=tree' if arg == '--profile' else arg for arg in sys.argv ]
     return main()
 
+def _early_boot_main():
+    '''Run early-boot without going through click and rich, as it sits on
+    the boot critical path. Logs go to the journal through stderr.
+    '''
+    from ..boot import boot_main
+    logging.basicConfig(level='INFO', format='%(message)s')
+    return boot_main()
+
 
 @click.group(invoke_without_command=True,
              help='Handy system extension manager for OSTree systems')
 @_use_common_group
+@click.option('--profile', is_flag=False, flag_value='tree', default=None,
+              type=click.Choice(['tree', 'json']),
+              help='Print the time spent in each phase, and with json, write a Chrome trace')
 @click.version_option(__version__)
 @click.pass_context
-def main(ctx: click.Context, **kwargs):
+def main(ctx: click.Context, profile: str, **kwargs):
     global sysroot
+    from rich.console import Console
+    from rich.logging import RichHandler
     _debug = os.getenv('OSTREE_SYSEXT_DEBUG') is not None
     logging.basicConfig(
             level    = 'DEBUG' if _debug else 'INFO',
@@ -46,58 +81,83 @@ def main(ctx: click.Context, **kwargs):
             handlers = [RichHandler(rich_tracebacks = True,
                                     tracebacks_suppress = [click],
                                     log_time_format     = "",
-                                    console             = cons,
+                                    console             = Console(stderr=True),
                                     show_path           = _debug)
                        ])
+    if profile is not None:
+        enable_tracing()
+        # Resources are closed in reverse order: the span ends before reporting
+        ctx.call_on_close(functools.partial(_report_profile, profile, os.getcwd()))
+        ctx.with_resource(span(f'ostree-sysext {ctx.invoked_subcommand or "list"}'))
     if kwargs['sysroot'] != '':
         os.chdir(kwargs['sysroot'])
     else:
         os.chdir('/')
     if ctx.invoked_subcommand is None:
-        list_command._cmd(cons, **kwargs)
+        from .commands import list_command
+        list_command._cmd(_console(), **kwargs)
 
 
 @main.command("list", help='List installed system extensions')
+@click.option('--output', type=click.Choice(['table', 'json', 'ndjson']), default='table',
+              show_default=True, help='Output format, ndjson prints each extension as it is found')
 @_use_common_group
 def _list(**kwargs):
-    list_command._cmd(cons, **kwargs)
+    from .commands import list_command
+    list_command._cmd(_console(), **kwargs)
 
 
 @main.command('add', help='Import a system extension without deploying it')
 @click.argument('ref', nargs=-1, required=True)
 @_use_common_group
 def _add(**kwargs):
-    add_remove._add(cons, **kwargs)
+    from .commands import add_remove
+    add_remove._add(_console(), **kwargs)
 
 @main.command("remove", help='Remove a system extension completely')
 @click.argument('sysext', nargs=-1, required=True)
 @_use_common_group
 def _remove(**kwargs):
-    add_remove._remove(cons, **kwargs)
+    from .commands import add_remove
+    add_remove._remove(_console(), **kwargs)
 
 
 @main.command("deploy", help='Deploy a system extension on top of this system')
 @click.argument('sysext', nargs=-1, required=True)
+@click.option('--force-recheck', is_flag=True,
+              help='Run plugin compatibility checks even if a verdict was cached')
+@click.option('--force', is_flag=True, help='Bypass plugin compatibility warnings')
 @_use_common_group
 def _deploy(**kwargs):
-    deploy._deploy(cons, **kwargs)
+    from .commands import deploy
+    deploy._deploy(_console(), **kwargs)
 
 @main.command("undeploy", help='Disable an active system extension')
 @click.argument('sysext', nargs=-1, required=True)
+@click.option('--force-recheck', is_flag=True,
+              help='Run plugin compatibility checks even if a verdict was cached')
+@click.option('--force', is_flag=True, help='Bypass plugin compatibility warnings')
 @_use_common_group
 def _undeploy(**kwargs):
-    deploy._undeploy(cons, **kwargs)
+    from .commands import deploy
+    deploy._undeploy(_console(), **kwargs)
 
 
-@main.command("rollback", help='Revert a system extension to a previous version')
+@main.command("rollback", help='Switch back to a previous set of system extensions')
+@click.argument('target', required=False)
+@click.option('--list', 'show_list', is_flag=True,
+              help='List previous deployment sets, most recent first')
+@click.option('--force', is_flag=True, help='Bypass plugin compatibility warnings')
 @_use_common_group
 def _rollback(**kwargs):
-    logging.warn("rollback")
+    from .commands import rollback
+    rollback._cmd(_console(), **kwargs)
 
 @main.command("mutate", help='Make a system directory read/write')
 @_use_common_group
 def _mutate(**kwargs):
-    mutate._cmd(cons, **kwargs)
+    from .commands import mutate
+    mutate._cmd(_console(), **kwargs)
 
 @main.command("build", help='Build a system extension from a Containerfile')
 @_use_common_group
@@ -111,9 +171,16 @@ def _edit(**kwargs):
 
 
 @main.command("upgrade", help='Update all system extensions')
+@click.option('--check', is_flag=True, help='Only check for updates, do not build them')
+@click.option('--force', is_flag=True, help='Bypass builder warnings')
+@click.option('--jobs', type=int, default=4, show_default=True,
+              help='Number of builders checking for updates concurrently')
+@click.option('--timeout', type=float, default=120, show_default=True,
+              help='Seconds after which an update check is given up')
 @_use_common_group
 def _upgrade(**kwargs):
-    logging.warn("upgrade")
+    from .commands import upgrade
+    upgrade._cmd(_console(), **kwargs)
 
 @main.command("live-update", help='Apply an update to the base system as an extension')
 @_use_common_group
@@ -126,12 +193,21 @@ def _initramfs(**kwargs):
     logging.warn("initramfs")
 
 
+@main.command("rebuild-index", help='Rescan all refs into the extension metadata index')
+@_use_common_group
+def _rebuild_index(**kwargs):
+    from .commands import rebuild_index
+    rebuild_index._cmd(_console(), **kwargs)
+
+
 @main.command("daemon", hidden=True,
               help='Internal command used to invoke daemon over D-Bus')
 def _daemon(**kwargs):
+    from ..dbus import dbus_main
     return dbus_main()
 
 @main.command("early-boot", hidden=True,
               help='Internal command used to load sysexts on boot')
 def _early_boot(**kwargs):
+    from ..boot import boot_main
     return boot_main()
@@ -7,12 +7,20 @@ from gi.repository  import OSTree, Gio
 
 from ..common       import find_sysext_by_ids
 from ...extensions  import DeployState, Extension
-from ...systemd     import refresh_sysexts
+from ...systemd     import refresh_sysexts, get_system_state
 from ...deployment  import DeploymentSet
 from ...repo        import open_system_repo
 from ...environment import MutableExtension, get_current_deployment
 
 
+def _commit_apply(ds: DeploymentSet, **args):
+    try:
+        ds.commit(force=args['force'], force_recheck=args['force_recheck'])
+        ds.apply(force=args['force'], force_recheck=args['force_recheck'])
+    except ValueError as e:
+        error(f"{e}")
+        exit(1)
+
 def _deploy(console: Console, **args):
     ds = get_current_deployment()
     if ds is None:
@@ -21,11 +29,13 @@ def _deploy(console: Console, **args):
         sr.load()
         ds = DeploymentSet(repo, root=sr.get_booted_deployment(), exts=[])
 
+    state = get_system_state()
     for ex in find_sysext_by_ids(args['sysext']):
-        if ex.get_state() == DeployState.EXTERNAL:
+        exstate = ex.get_state(state)
+        if exstate == DeployState.EXTERNAL:
             warn(f"Extension '{ex.get_id()}' is not managed by OSTree-sysext.")
             continue
-        if ex.get_state() == DeployState.ACTIVE:
+        if exstate == DeployState.ACTIVE:
             warn(f"Extension '{ex.get_id()}' is already active.")
             continue
         if type(ex) is MutableExtension:
@@ -33,25 +43,27 @@ def _deploy(console: Console, **args):
         else:
             ds.exts.append(ex)
 
-    ds.commit()
-    ds.apply()
+    _commit_apply(ds, **args)
     refresh_sysexts('--mutable=auto') # TODO: track auto vs imported
+    ds.retain_history()
 
 def _undeploy(console: Console, **args):
     ds = get_current_deployment()
 
+    state = get_system_state()
     for ex in find_sysext_by_ids(args['sysext']):
-        if ex.get_state() == DeployState.EXTERNAL:
+        exstate = ex.get_state(state)
+        if exstate == DeployState.EXTERNAL:
             warn(f"Extension '{ex.get_id()}' is not managed by OSTree-sysext.")
             continue
-        if ex.get_state() == DeployState.INACTIVE:
+        if exstate == DeployState.INACTIVE:
             warn(f"Extension '{ex.get_id()}' is already inactive.")
             continue
         if type(ex) is MutableExtension:
             ex.undeploy()
         else:
-            ds.exts.remove(ex)
+            ds.exts = [dex for dex in ds.exts if dex.get_id() != ex.get_id()]
 
-    ds.commit()
-    ds.apply()
+    _commit_apply(ds, **args)
     refresh_sysexts('--mutable=auto')
+    ds.retain_history()
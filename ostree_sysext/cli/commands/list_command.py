@@ -1,13 +1,18 @@
 import os
+import sys
+import json
 
 from rich.console   import Console
 from rich.table     import Table
 from rich.text      import Text
 from rich           import box
 from logging        import debug, error, warn
+from itertools      import chain
 
 from ...extensions  import DeployState, Extension
-from ...environment import list_sysexts, list_mutables
+from ...environment import iter_sysexts, list_mutables
+from ...systemd     import SystemState, get_system_state
+from ...dbus.client import list_extensions
 
 table_states = {
     DeployState.ACTIVE:   Text("active",    style="green bold"),
@@ -20,24 +25,70 @@ table_states = {
     DeployState.OUTDATED: Text("outdated",  style="red bold")
 }
 
-def print_extension(tb: Table, ext: Extension):
-    tb.add_row(ext.get_id(), ext.get_name(), ext.get_version(), table_states[ext.get_state()])
+def print_extension(tb: Table, ext: Extension, state: SystemState):
+    tb.add_row(ext.get_id(), ext.get_name(), ext.get_version(), table_states[ext.get_state(state)])
+
+def extension_record(ext: Extension, state: SystemState) -> dict:
+    '''Describe an extension for machine-readable output.
+    Fields which do not apply to the kind of extension are null.
+    '''
+    return { 'id':      ext.get_id(),
+             'name':    ext.get_name(),
+             'version': ext.get_version(),
+             'state':   ext.get_state(state).name.lower(),
+             'commit':  getattr(ext, 'commit', None),
+             'builder': getattr(ext, 'builder', None),
+             'origin':  getattr(ext, 'origin', None) }
+
+def _stream(fmt: str):
+    '''Write each extension to stdout as soon as it is resolved, either as
+    one JSON object per line, or as the elements of a single JSON array.
+    '''
+    state = get_system_state()
+    if fmt == 'json':
+        sys.stdout.write('[')
+    first = True
+    for ext in chain(iter_sysexts(), list_mutables()):
+        rec = json.dumps(extension_record(ext, state))
+        if fmt == 'json':
+            sys.stdout.write(rec if first else f',\n{rec}')
+        else:
+            sys.stdout.write(f'{rec}\n')
+            sys.stdout.flush()
+        first = False
+    if fmt == 'json':
+        sys.stdout.write(']\n')
 
 def _cmd(console: Console, **args):
+    fmt = args.get('output') or 'table'
+    if fmt != 'table':
+        # The daemon does not report commits, builders and origins
+        return _stream(fmt)
+
     tb = Table(box=box.SIMPLE)
     tb.add_column("ID", justify="right", no_wrap=True)
     tb.add_column("NAME")
     tb.add_column("VERSION", no_wrap=True)
     tb.add_column("STATE")
 
-    for ext in list_sysexts():
-        print_extension(tb, ext)
+    # The daemon only knows about the booted root
+    rows = list_extensions() if os.getcwd() == '/' else None
+    if rows is not None:
+        for id, name, version, state in rows:
+            tb.add_row(id, name, version, table_states[state])
+        tb.add_row()
+        console.print(tb)
+        return
+
+    state = get_system_state()
+    for ext in iter_sysexts():
+        print_extension(tb, ext, state)
 
     mutables = list_mutables()
     if len(mutables) > 0:
         tb.add_row()
         for mut in mutables:
-            print_extension(tb, mut)
+            print_extension(tb, mut, state)
 
     tb.add_row()
 
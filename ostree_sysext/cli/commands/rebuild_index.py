@@ -0,0 +1,19 @@
+import os
+
+from rich.console   import Console
+from logging        import debug, error, warn, info
+from pathlib        import Path
+
+from ...repo        import ExtensionIndex, open_system_repo, find_sysext_refs, SCAN_WORKERS
+
+
+def _cmd(console: Console, **args):
+    repo = open_system_repo(Path('ostree'))
+    index = ExtensionIndex(repo)
+    index.clear()
+
+    refs = list(find_sysext_refs(repo, index=index, workers=SCAN_WORKERS))
+    if index.dirty:
+        error("Could not write extension index.")
+        exit(1)
+    info(f"Indexed {len(index.entries)} commits, {len(refs)} system extensions.")
@@ -0,0 +1,69 @@
+from datetime       import datetime
+from rich.console   import Console
+from rich.table     import Table
+from rich           import box
+from logging        import debug, error, warn, info
+from gi.repository  import OSTree
+
+from ...systemd     import refresh_sysexts
+from ...deployment  import DeploymentSet
+from ...environment import get_current_deployment
+
+
+def _print_history(console: Console, ds: DeploymentSet, chain: list[str]):
+    tb = Table(box=box.SIMPLE)
+    tb.add_column("#", justify="right")
+    tb.add_column("COMMIT", no_wrap=True)
+    tb.add_column("DATE", no_wrap=True)
+    tb.add_column("EXTENSIONS")
+    tb.add_column("CHECKED OUT")
+    for n, ref in enumerate(chain):
+        ok, commitv, _s = ds.repo.load_commit(ref)
+        date = datetime.fromtimestamp(OSTree.commit_get_timestamp(commitv))
+        exts = DeploymentSet(ds.repo, ref, root=ds.root).get_extensions()
+        tb.add_row(str(n), ref[:12], date.strftime('%Y-%m-%d %H:%M'),
+                   ", ".join(ext.get_id() for ext in exts),
+                   "yes" if ds._deploy_space().joinpath(f'{ref}.0').exists() else "no")
+    tb.add_row()
+    console.print(tb)
+
+def _resolve_target(chain: list[str], target: str) -> str:
+    if target is None:
+        target = '1'
+    if target.isdigit() and len(target) < 12:
+        if int(target) >= len(chain):
+            return None
+        return chain[int(target)]
+    match = list(dict.fromkeys(ref for ref in chain if ref.startswith(target)))
+    return match[0] if len(match) == 1 else None
+
+def _cmd(console: Console, **args):
+    ds = get_current_deployment()
+    if ds is None:
+        error("No deployment set is active.")
+        exit(1)
+    chain = ds.history()
+    if args['show_list']:
+        return _print_history(console, ds, chain)
+
+    target = _resolve_target(chain, args['target'])
+    if target is None:
+        error(f"No previous deployment set matches '{args['target'] or 1}'.")
+        exit(1)
+    if target == ds.ref:
+        warn("This deployment set is already active.")
+        return
+
+    # The target was committed before, so its plugin verdicts and state are
+    # reused as is, and only extensions which differ are remounted.
+    # It is only used for the next boot once it was applied.
+    prev = DeploymentSet(ds.repo, target, root=ds.root)
+    try:
+        prev.apply(force=args['force'])
+        prev.pin()
+    except (ValueError, OSError) as e:
+        error(f"Could not roll back to deployment set {target[:12]}: {e}")
+        exit(1)
+    refresh_sysexts('--mutable=auto')
+    prev.retain_history()
+    info(f"Rolled back to deployment set {target[:12]}.")
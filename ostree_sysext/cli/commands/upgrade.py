@@ -0,0 +1,43 @@
+import os
+
+from rich.console   import Console
+from rich.table     import Table
+from rich.text      import Text
+from rich           import box
+from logging        import debug, error, warn, info
+from pathlib        import Path
+from gi.repository  import OSTree
+
+from ...extensions  import UpdateState, CompatVote
+from ...environment import list_sysexts
+from ...repo        import RepoExtension, open_system_repo
+from ...upgrade     import upgrade
+
+table_updates = {
+    UpdateState.AVAIL:   Text("available",   style="green bold"),
+    UpdateState.WARN:    Text("warning",     style="yellow bold"),
+    UpdateState.VETO:    Text("impossible",  style="red bold"),
+    UpdateState.UNAVAIL: Text("up to date"),
+    UpdateState.UNKNOWN: Text("unknown",     style="red")
+}
+
+def _cmd(console: Console, **args):
+    repo = open_system_repo(Path('ostree'))
+    sr = OSTree.Sysroot()
+    sr.load()
+    exts = [ex for ex in list_sysexts() if type(ex) is RepoExtension]
+
+    report = upgrade(repo, sr.get_booted_deployment(), exts, force=args['force'],
+                     jobs=args['jobs'], timeout=args['timeout'], check_only=args['check'])
+
+    tb = Table(box=box.SIMPLE)
+    tb.add_column("ID", justify="right", no_wrap=True)
+    tb.add_column("UPDATE")
+    tb.add_column("DETAILS")
+    for id, (res, msg) in report.checks.items():
+        if id in report.builds and report.builds[id][0] != CompatVote.APPROVE:
+            msg = report.builds[id][1]
+        tb.add_row(id, table_updates[res], msg)
+    tb.add_row()
+    console.print(tb)
+    info(f"Upgrade: {report}")
@@ -1,15 +1,13 @@
 from logging        import debug, error, warn
 
-from ..environment  import list_sysexts, list_mutables
+from ..environment  import find_sysexts
 from ..extensions   import DeployState, Extension
 
 def find_sysext_by_ids(ids: list[str]) -> list[Extension]:
-    exts = list_sysexts() + list_mutables()
-    match = []
+    found = find_sysexts(ids)
 
     for exid in ids:
-        match += [x for x in exts if x.get_id() == exid]
-        if len(match) == 0:
+        if exid not in found:
             error(f"Extension '{exid}' not found.")
             exit(1)
-    return match
+    return [found[exid] for exid in ids]
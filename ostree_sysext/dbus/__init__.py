@@ -1,18 +1,10 @@
-import os
-import pwd
-
-from pydbus     import SystemBus
-from logging    import warn, error
-
-build_user: int
+BUS_NAME = 'io.thesola.OSTreeSysext1'
+OBJECT_PATH = '/io/thesola/OSTreeSysext1'
 
 def dbus_main():
-    global build_user
-
-    try:
-        build_user = pwd.getpwnam("ostree-sysext")
-    except:
-        error("User 'ostree-sysext' does not exist.")
-        exit(1)
-
-    warn("hello")
+    '''Run the resident D-Bus daemon.
+    The daemon pulls in pydbus and the whole model, so it is only imported
+    when actually started.
+    '''
+    from .daemon import daemon_main
+    return daemon_main()
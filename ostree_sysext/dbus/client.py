@@ -0,0 +1,32 @@
+from logging        import debug
+
+from ..extensions   import DeployState
+from .              import BUS_NAME, OBJECT_PATH
+
+def get_daemon():
+    '''Return a proxy to the running ostree-sysext daemon, or None if it is
+    not running. The daemon is never activated just for this.
+    '''
+    try:
+        from pydbus import SystemBus
+        bus = SystemBus()
+        if not bus.dbus.NameHasOwner(BUS_NAME):
+            return None
+        return bus.get(BUS_NAME, OBJECT_PATH)
+    except Exception as e:
+        debug(f"Daemon not available: {e}")
+        return None
+
+def list_extensions() -> list[tuple[str, str, str, DeployState]]:
+    '''Return (id, name, version, state) for all extensions known to the
+    daemon, or None to fall back to direct mode.
+    '''
+    daemon = get_daemon()
+    if daemon is None:
+        return None
+    try:
+        return [ (id, name, version, DeployState[state])
+                 for id, name, version, state in daemon.List() ]
+    except Exception as e:
+        debug(f"Daemon query failed: {e}")
+        return None
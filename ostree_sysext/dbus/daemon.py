@@ -0,0 +1,236 @@
+import os
+import pwd
+
+from pydbus         import SystemBus
+from gi.repository  import GLib
+from logging        import warn, error, debug
+from pathlib        import Path
+from ctypes         import CDLL, c_char_p, c_int, c_uint32, get_errno
+from ctypes.util    import find_library
+
+from ..environment  import list_sysexts, list_mutables, get_current_deployment
+from ..extensions   import Extension, DeployState
+from ..repo         import RepoExtension
+from ..systemd      import get_system_state, invalidate_system_state
+from ..mounts       import invalidate_mount_table
+from .              import BUS_NAME, OBJECT_PATH
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DONT_FOLLOW  = 0x02000000
+IN_NONBLOCK     = 0o4000
+IN_CLOEXEC      = 0o2000000
+
+WATCH_MASK = IN_MODIFY|IN_ATTRIB|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+
+# Trees whose changes invalidate the cached model, watched recursively
+WATCHED_TREES = [ Path('ostree', 'repo', 'refs') ]
+# Directories whose entries changing invalidates the cached model.
+# /run/ostree/extensions is a symlink replaced on apply, so its parent is
+# watched rather than the deployment set it points to.
+WATCHED_PATHS = [ Extension.DEPLOY_PATH,
+                  Path('/', 'run', 'ostree') ]
+
+libc = CDLL(find_library('c'), use_errno=True)
+libc.inotify_init1.argtypes = (c_int,)
+libc.inotify_add_watch.argtypes = (c_int, c_char_p, c_uint32)
+
+build_user: int
+
+
+def _interface(name: str) -> str:
+    return Path(__file__).parent.joinpath(f'{BUS_NAME}.{name}.xml').read_text()
+
+def _escape_path(id: str) -> str:
+    '''Escape an extension ID into a valid D-Bus object path element.
+    '''
+    return ''.join(c if c.isalnum() else f'_{ord(c):02x}' for c in id)
+
+
+class SysextModel:
+    '''In-memory model of extensions and deployment state.
+    It is rebuilt on the next query after an inotify event invalidated it,
+    so polling clients do not cause any repository or systemd access.
+    '''
+    valid: bool
+    extensions: list[Extension]
+    states: dict[str, DeployState]
+    deployment: str
+
+    def __init__(self):
+        self.valid = False
+
+    def invalidate(self):
+        self.valid = False
+        invalidate_system_state()
+        invalidate_mount_table()
+
+    def refresh(self):
+        if self.valid:
+            return
+        state = get_system_state()
+        self.extensions = list_sysexts() + list_mutables()
+        self.states = { ext.get_id(): ext.get_state(state) for ext in self.extensions }
+        ds = get_current_deployment()
+        self.deployment = ds.ref if ds is not None else ""
+        self.valid = True
+
+
+class Watcher:
+    '''inotify watches on WATCHED_TREES and WATCHED_PATHS, integrated in the
+    GLib main loop. Paths which do not exist yet are watched through their
+    parent, and symlinks are never followed.
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+        self.fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno())
+        self._add_watches()
+        GLib.io_add_watch(self.fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_event)
+
+        # The mount table signals changes, such as systemd-sysext merges,
+        # as an exceptional condition
+        self.mounts = open('/proc/self/mountinfo')
+        GLib.io_add_watch(self.mounts.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_PRI|GLib.IO_ERR, self._on_mounts)
+
+    def _watch(self, path: Path):
+        while not path.exists():
+            path = path.parent
+        libc.inotify_add_watch(self.fd, str(path).encode(), WATCH_MASK|IN_DONT_FOLLOW)
+
+    def _add_watches(self):
+        # Refs are nested in per-remote directories, watch all of them.
+        # Watches are per-inode, so adding one again is harmless.
+        for path in WATCHED_TREES:
+            self._watch(path)
+            if path.is_dir() and not path.is_symlink():
+                for sub, dirs, files in os.walk(path):
+                    for d in dirs:
+                        self._watch(Path(sub, d))
+        for path in WATCHED_PATHS:
+            self._watch(path)
+
+    def _on_event(self, fd, cond):
+        try:
+            while len(os.read(fd, 4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        self._add_watches()
+        self.callback()
+        return True
+
+    def _on_mounts(self, fd, cond):
+        self.mounts.seek(0)
+        self.mounts.read()
+        self.callback()
+        return True
+
+
+class ExtensionObject:
+    dbus = _interface('Extension')
+
+    def __init__(self, model: SysextModel, ext: Extension):
+        self.model = model
+        self.ext = ext
+
+    @property
+    def Id(self):
+        return self.ext.get_id()
+
+    @property
+    def ReleaseInfo(self):
+        try:
+            return { k: GLib.Variant('s', v) for k, v in self.ext.get_rel_info().items() }
+        except ValueError:
+            return {}
+
+    @property
+    def Path(self):
+        try:
+            if isinstance(self.ext, RepoExtension):
+                return str(self.ext.checkout_path())    # Do not check out on a property read
+            return str(self.ext.get_root())
+        except:
+            return ""
+
+    @property
+    def Managed(self):
+        return self.model.states[self.ext.get_id()] != DeployState.EXTERNAL
+
+    @property
+    def Active(self):
+        return self.model.states[self.ext.get_id()] in (DeployState.ACTIVE, DeployState.IMPORTED)
+
+    @property
+    def Staged(self):
+        return self.model.states[self.ext.get_id()] in (DeployState.ACTIVE, DeployState.STAGED)
+
+
+class SysrootObject:
+    dbus = _interface('Sysroot')
+
+    def __init__(self, bus, model: SysextModel):
+        self.bus = bus
+        self.model = model
+        self.registrations = {}
+        # Kept alive along with the object, as it holds the inotify fd
+        self.watcher = Watcher(model.invalidate)
+
+    def _sync(self):
+        '''Refresh the model if needed, and publish one object per extension.
+        '''
+        if self.model.valid:
+            return
+        self.model.refresh()
+        for reg in self.registrations.values():
+            reg.unregister()
+        self.registrations = {}
+        for ext in self.model.extensions:
+            path = f'{OBJECT_PATH}/extension/{_escape_path(ext.get_id())}'
+            self.registrations[path] = self.bus.register_object(path,
+                                                                ExtensionObject(self.model, ext),
+                                                                None)
+
+    @property
+    def Path(self):
+        return os.getcwd()
+
+    @property
+    def Extensions(self):
+        self._sync()
+        return list(self.registrations.keys())
+
+    def List(self):
+        self._sync()
+        return [ (ext.get_id(), ext.get_name(), ext.get_version(),
+                  self.model.states[ext.get_id()].name)
+                 for ext in self.model.extensions ]
+
+    def Status(self):
+        self._sync()
+        active = [id for id, st in self.model.states.items() if st == DeployState.ACTIVE]
+        return self.model.deployment, active
+
+
+def daemon_main():
+    global build_user
+
+    try:
+        build_user = pwd.getpwnam("ostree-sysext")
+    except:
+        error("User 'ostree-sysext' does not exist.")
+        exit(1)
+
+    bus = SystemBus()
+    model = SysextModel()
+    sysroot = SysrootObject(bus, model)
+    bus.publish(BUS_NAME, (OBJECT_PATH, sysroot))
+    debug(f"Serving {BUS_NAME}")
+    GLib.MainLoop().run()
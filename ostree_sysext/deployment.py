@@ -1,33 +1,178 @@
 import os
+import json
+import shutil
 
-from gi.repository  import Gio, OSTree
-from logging        import warn, error
+from gi.repository  import Gio, GLib, OSTree
+from logging        import warn, error, info
 from pathlib        import Path
 from tempfile       import mkdtemp
+from collections    import ChainMap
 
-from .repo          import RepoExtension, open_system_repo, ref_is_deployment_set, commit_dir, pin_ref, deploy_aware, NOFLAGS
-from .extensions    import Extension, DeployState
-from .plugin        import survey_compatible, survey_deploy_finish
-from .sandbox       import umount, edit_sysroot
+from .repo          import RepoExtension, ExtensionIndex, RepoIndex, open_system_repo, ref_is_deployment_set, \
+                           read_commit_metadata, \
+                           deploy_aware, checkout_is_full, composefs_is_enabled, composefs_digest, \
+                           SysrootTransaction, NOFLAGS
+from .extensions    import Extension, DeployState, CompatVote, read_applied, write_applied
+from .plugin        import survey_compatible, survey_deploy_finish, set_key, list_plugins
+from .sandbox       import umount, edit_sysroot, exchange, replace_symlink, give_to_sandbox, \
+                           MountExecutor, \
+                           MOUNT_JOBS, MNT_DETACH, COMPOSEFS_MOUNTS
+from .mounts        import invalidate_mount_table
+from .trace         import span, traced
+
+
+class ApplyPlan:
+    '''Operations needed to go from the extensions currently deployed under
+    Extension.DEPLOY_PATH to a given list of extensions.
+    '''
+    keep: dict[str, str]
+    mount: list[RepoExtension]
+    swap: list[RepoExtension]
+    unmount: list[str]
+    errors: dict[str, Exception]
+
+    def __init__(self, current: dict[str, str], exts: list[RepoExtension]):
+        # Permit duplicate entries, last entry for ID wins
+        target = { ext.get_id(): ext for ext in exts }
+
+        self.keep = {}
+        self.mount = []
+        self.swap = []
+        for id, ext in target.items():
+            if id not in current:
+                self.mount.append(ext)
+            elif current[id] == ext.commit:
+                self.keep[id] = ext.commit
+            else:
+                self.swap.append(ext)
+        self.unmount = [id for id in current.keys() if id not in target]
+        self.errors = {}
+
+    def operations(self) -> int:
+        return len(self.mount) + len(self.swap) + len(self.unmount)
+
+    def __str__(self):
+        return f"{len(self.keep)} kept, {len(self.mount)} mounted, " \
+               f"{len(self.swap)} swapped, {len(self.unmount)} unmounted"
+
+
+def _applied_extensions(applied: dict) -> dict[str, str]:
+    '''Map each entry under Extension.DEPLOY_PATH to the commit it deploys,
+    or None if it is unknown.
+    '''
+    recorded = applied.get('extensions', {})
+    current = {}
+    if not Extension.DEPLOY_PATH.exists():
+        return current
+    for ent in Extension.DEPLOY_PATH.iterdir():
+        if ent.is_symlink():
+            current[ent.name] = ent.readlink().name[:-2]
+        elif ent.is_mount():
+            current[ent.name] = recorded.get(ent.name)
+        else:
+            raise ValueError(f"Found {str(ent)}, which is neither a mount nor a symlink.")
+    return current
+
+def _remove_deployed(ent: Path):
+    if ent.is_symlink():
+        ent.unlink()
+    elif ent.is_mount():
+        umount(str(ent), MNT_DETACH)    # May still be merged until the next refresh
+        ent.rmdir()
+    else:
+        raise ValueError(f"Found {str(ent)}, which is neither a mount nor a symlink.")
+
+def _remove_tree(path: Path):
+    '''Remove a swapped out deployment path, and every entry it holds if it
+    is a plain directory.
+    '''
+    if path.is_symlink() or path.is_mount():
+        return _remove_deployed(path)
+    for ent in path.iterdir():
+        _remove_deployed(ent)
+    path.rmdir()
+
+def _swap_in(staged: Path, dest: Path):
+    '''Atomically put staged in place of dest, then remove the old dest.
+    Symlinks are renamed over each other, anything else is exchanged.
+    A mount point cannot be exchanged, so one left by an older version is
+    detached first, without atomicity.
+    '''
+    if dest.is_mount():
+        umount(dest, MNT_DETACH)
+        dest.rmdir()
+    if not os.path.lexists(dest) or (staged.is_symlink() and dest.is_symlink()):
+        os.replace(staged, dest)
+        return
+    exchange(staged, dest)
+    _remove_tree(staged)
+
+def _unmount_unused(used: set[Path]):
+    '''Unmount composefs images which are no longer deployed.
+    They are detached, as the merged sysext overlay still uses them until
+    it is refreshed, and are released by the kernel afterwards.
+    '''
+    if not COMPOSEFS_MOUNTS.exists():
+        return
+    for mnt in COMPOSEFS_MOUNTS.iterdir():
+        if mnt not in used and mnt.is_mount():
+            try:
+                umount(mnt, MNT_DETACH)
+                mnt.rmdir()
+            except OSError as e:
+                warn(f"Could not unmount unused image {mnt.name}: {e}")
+
+
+# Number of recent deployment sets kept checked out for rollback, unless
+# overridden by 'keep-sets' in the [sysext] section of the repository config
+KEEP_SETS = 3
+
+def keep_sets(repo: OSTree.Repo) -> int:
+    try:
+        return repo.get_config().get_integer('sysext', 'keep-sets')
+    except GLib.Error:
+        return KEEP_SETS
+
+def _remove_trees(paths: list[Path]) -> str:
+    for path in paths:
+        shutil.rmtree(path)
+    return ""
+
+
+class SetIndex(RepoIndex):
+    '''Map of deployment set content keys to the commit holding that set.
+    '''
+    INDEX_PATH = Path('extensions', 'ostree-sysext', 'sets.json')
+
+class HistoryIndex(RepoIndex):
+    '''Map of root deployments, by pin ref, to the deployment sets applied
+    on them, newest first. Sets reused by content key are not descendants
+    of the set applied before them, so commit parents cannot tell this.
+    '''
+    INDEX_PATH = Path('extensions', 'ostree-sysext', 'history.json')
+
+# Number of applied sets remembered per root deployment
+HISTORY_LENGTH = 32
 
 
 class DeploymentSet:
     DEPLOY_PATH = Path('/','run','ostree','extensions')
+    KEY_METADATA = 'ostree-sysext.set-key'
+    BOOT_MANIFEST = Path('state', 'ostree-sysext', 'boot.json')
+    COMPAT_CACHE = Path('state', 'ostree-sysext', 'compat.json')
 
     exts: list[RepoExtension]
     repo: OSTree.Repo
     root: OSTree.Deployment
     ref: str
 
-    # Hash of properties to invalidate ref
-    digest: int
-
     def __init__(self, repo: OSTree.Repo, ref: str = None,
                  root: OSTree.Deployment = None,
                  exts: list[RepoExtension] = None):
         '''Construct a DeploymentSet.
         If ref is set, the relevant OSTree commit is opened and this object
-        is constructed from its contents.
+        is constructed from its contents, for the given root or otherwise the
+        booted deployment.
 
         If a root and exts are set, the object is constructed without a commit.
         '''
@@ -38,90 +183,325 @@ class DeploymentSet:
             self.exts = exts
             self.ref = None
 
-        elif root is None and exts is None:
+        elif exts is None:
             self.exts = []
             commit = repo.read_commit(ref)
             assert ref_is_deployment_set(commit)
 
             self.ref = commit.out_commit
 
+            index = ExtensionIndex(repo)
             staged = commit.out_root.get_child('staged')
             staged_files = list(staged.enumerate_children("standard::*", NOFLAGS))
             for sfile in staged_files:
                 target = sfile.get_attribute_as_string("standard::symlink-target")
-                self.exts.append(RepoExtension(repo, target[-66:-2]))
-
-            sysroot = OSTree.Sysroot()
-            sysroot.load()
-            self.root = sysroot.get_booted_deployment()
+                self.exts.append(RepoExtension(repo, target[-66:-2], index))
+            index.save()
 
-            self.digest = hash(tuple(self.exts))
+            if root is None:
+                sysroot = OSTree.Sysroot()
+                sysroot.load()
+                root = sysroot.get_booted_deployment()
+            self.root = root
         else:
-            raise ValueError("ref cannot be specified alongside root and exts")
+            raise ValueError("ref cannot be specified alongside exts")
 
-    def _is_committed(self) -> bool:
-        if self.ref is None:
-            return False
-        if hash(tuple(self.exts)) != self.digest:
-            return False
-        return True
+    def _find_committed(self, key: str, index: SetIndex) -> str:
+        '''Return an existing commit for this set's content key, or None.
+        '''
+        for commit in (self.ref, index.entries.get(key)):
+            if commit is None:
+                continue
+            try:
+                if read_commit_metadata(self.repo, commit, self.KEY_METADATA) == key:
+                    return commit
+            except:
+                pass    # Pruned from the repository since it was indexed
+        return None
 
-    def commit(self, force = False) -> str:
-        '''Write and pin an OSTree commit for the given deployment state
+    @traced('deployment.commit')
+    def commit(self, force = False, force_recheck = False) -> str:
+        '''Write and pin an OSTree commit for the given deployment state.
+        If the same set was committed before, that commit is pinned and
+        returned without running plugins, unless force_recheck is set.
         '''
-        if self._is_committed():
+        key = set_key(self.root, self.exts)
+        index = SetIndex(self.repo)
+        found = None if force_recheck else self._find_committed(key, index)
+        if found is not None:
+            self.ref = found
+            self.pin()
             return self.ref
 
-        tgt = mkdtemp(prefix="ostree-sysext-")
-        survey_compatible(self.root, self.exts, force)
+        self._checkout_missing()
+        # Reuse the parent set's verdicts, but only record the ones for this set
+        compat = ChainMap({}, {} if force_recheck else self._read_state(self.COMPAT_CACHE))
+        self._check_verdict(survey_compatible(self.root, self.exts, force, compat))
 
-        Path(tgt, 'staged').mkdir()
-        for ext in self.exts:
-            # Permit duplicate entries, last entry for ID wins
-            Path(tgt, 'staged', ext.get_id()).unlink(missing_ok=True)
-            Path(tgt, 'staged', ext.get_id()).symlink_to(f"/{ext.get_root()}")
-
-        Path(tgt, 'state').mkdir()
-        survey_deploy_finish(self.root, self.exts, tgt, force)
-
-        err, ref = edit_sysroot(lambda: (0, commit_dir(self.repo, tgt, parent=self.ref)))
-        if err:
-            raise OSError(err)
-        self.ref = ref
-        self.digest = hash(tuple(self.exts))
-
-        self.repo = OSTree.Repo.new(self.repo.get_path())
-        self.repo.open()
-        # TODO: flip-flop ref pin @ ostree-sysext/osname/<deploy>/<ext>
+        tgt = mkdtemp(prefix="ostree-sysext-")
+        try:
+            self.ref = self._write_set(Path(tgt), key, force, compat)
+        finally:
+            shutil.rmtree(tgt, ignore_errors=True)
+        index.entries[key] = self.ref
+        index.dirty = True
+        index.save()
         return self.ref
 
-    def apply(self, force = False, syslink = True):
-        '''Apply and replace the current deployment set with this one.
-        Will also update /run/extensions.
+    def _write_set(self, tgt: Path, key: str, force: bool, compat: ChainMap) -> str:
+        '''Stage this set and its plugin state in tgt, then commit, pin and
+        check it out. Returns the new commit.
         '''
-        survey_compatible(self.root, self.exts, force)
-
-        dep_space = Path('/', 'ostree', 'deploy', self.root.get_osname(), 'extensions', 'deploy')
-        deploy_aware(self.repo, self.ref, dep_space, self.DEPLOY_PATH)
-
-        Extension.DEPLOY_PATH.mkdir(parents=True, exist_ok=True)
-        for ent in Extension.DEPLOY_PATH.iterdir():
-            if ent.is_mount():
-                umount(str(ent))
-                ent.rmdir()
-            elif ent.is_symlink():
-                ent.unlink()
-            else:
-                raise ValueError(f"Found {str(ent)}, which is neither a mount nor a symlink.")
+        tgt.joinpath('staged').mkdir()
+        with span('deployment.stage', exts=len(self.exts)):
+            for ext in self.exts:
+                # Permit duplicate entries, last entry for ID wins
+                tgt.joinpath('staged', ext.get_id()).unlink(missing_ok=True)
+                tgt.joinpath('staged', ext.get_id()).symlink_to(ext.deploy_path())
+
+        tgt.joinpath('state').mkdir()
+        if self.ref is not None:
+            tgt.joinpath('parent').write_text(self.ref)    # Left out of the overlay commit
+        # Plugins write their state as the sandbox user
+        give_to_sandbox(tgt, tgt.joinpath('state'))
+        self._check_verdict(survey_deploy_finish(self.root, self.exts, tgt, force))
+        self._write_boot_manifest(tgt.joinpath(self.BOOT_MANIFEST))
+        with tgt.joinpath(self.COMPAT_CACHE).open('w') as f:
+            json.dump(compat.maps[0], f)
+
+        # Commit, pin and check out the new set in a single privileged child
+        tx = SysrootTransaction(self.repo)
+        # Subtrees of the parent's state which plugins did not write are kept,
+        # except those of plugins which were removed since
+        overlay = ['staged'] + [f'state/{ent.name}' for ent in tgt.joinpath('state').iterdir()]
+        overlay += [sub for sub in self._stale_state() if sub not in overlay]
+        new = tx.commit(tgt, parent=self.ref, meta={ self.KEY_METADATA: key }, overlay=overlay)
+        tx.set_ref(self._pin_ref(), new)
+        # Set trees are tiny, and early-boot reads the boot manifest from them
+        tx.checkout(new, self._deploy_space(), materialize=True)
+        return tx.run()[new]
+
+    def _check_verdict(self, verdict: tuple[CompatVote, str]):
+        '''Raise if a plugin vetoed this set, or warned about it without force.
+        '''
+        res, msg = verdict
+        if res != CompatVote.APPROVE:
+            raise ValueError(f"Deployment set rejected by {msg}"
+                             + (", use --force to bypass" if res == CompatVote.WARN else ""))
+
+    def _stale_state(self) -> list[str]:
+        '''Return the state/ subdirectories of the committed set which belong
+        neither to an installed plugin nor to ostree-sysext itself.
+        '''
+        if self.ref is None:
+            return []
+        owners = set(list_plugins()) | { self.BOOT_MANIFEST.parts[1] }
+        try:
+            state = self.repo.read_commit(self.ref).out_root.get_child('state')
+            names = [f.get_name() for f in state.enumerate_children("standard::name", NOFLAGS)]
+        except GLib.Error:
+            return []
+        return [f'state/{name}' for name in names if name not in owners]
+
+    def pin(self):
+        '''Make this committed set the one used for its root deployment.
+        '''
+        ok, pinned = self.repo.resolve_rev(self._pin_ref(), True)
+        if pinned != self.ref:
+            tx = SysrootTransaction(self.repo)
+            tx.set_ref(self._pin_ref(), self.ref)
+            tx.run()
+
+    def record_applied(self):
+        '''Add this set to the history of sets applied on its root deployment.
+        '''
+        index = HistoryIndex(self.repo)
+        chain = index.entries.get(self._pin_ref(), [])
+        if chain[:1] == [self.ref]:
+            return
+        index.entries[self._pin_ref()] = ([self.ref] + chain)[:HISTORY_LENGTH]
+        index.dirty = True
+        index.save()
+
+    def history(self) -> list[str]:
+        '''Return this set's commit followed by the sets applied before it on
+        its root deployment, newest first, leaving out those missing from the
+        repository. Without a recorded history, the sets it was derived from
+        are returned instead.
+        '''
+        chain = HistoryIndex(self.repo).entries.get(self._pin_ref(), [])
+        if len(chain) == 0:
+            commit = self.ref
+            while commit is not None:
+                try:
+                    ok, commitv, _s = self.repo.load_commit(commit)
+                except GLib.Error:
+                    break
+                chain.append(commit)
+                commit = OSTree.commit_get_parent(commitv)
+        if chain[:1] != [self.ref]:
+            chain = [self.ref] + chain
+
+        present = {}
+        for commit in chain:
+            if commit not in present:
+                try:
+                    self.repo.load_commit(commit)
+                    present[commit] = True
+                except GLib.Error:
+                    present[commit] = False
+        return [commit for commit in chain if present[commit]]
+
+    @traced('deployment.retain')
+    def retain_history(self, keep: int = None):
+        '''Keep the most recent sets of this set's history fully checked out,
+        so that rolling back to them needs no checkout, and remove the
+        checkouts of older sets which no deployment uses.
+        '''
+        if keep is None:
+            keep = keep_sets(self.repo)
+        chain = list(dict.fromkeys(self.history()))
+        for ref in chain[:keep]:
+            DeploymentSet(self.repo, ref, root=self.root)._checkout_missing(with_set=True)
+
+        try:
+            ok, pins = self.repo.list_refs_ext(f'ostree-sysext/{self.root.get_osname()}',
+                                               OSTree.RepoListRefsExtFlags.NONE, None)
+        except GLib.Error:
+            pins = {}
+        stale = [ self._deploy_space().joinpath(f'{ref}.0') for ref in chain[keep:]
+                  if ref not in pins.values() ]
+        stale = [ path for path in stale if path.exists() ]
+        if len(stale) > 0:
+            edit_sysroot(lambda: (0, _remove_trees(stale)))
+
+    def _pin_ref(self) -> str:
+        return f'ostree-sysext/{self.root.get_osname()}/{self.root.get_csum()}.{self.root.get_deployserial()}'
+
+    def _deploy_space(self) -> Path:
+        return Path('ostree', 'deploy', self.root.get_osname(), 'extensions', 'deploy')
+
+    @traced('deployment.checkout_missing')
+    def _checkout_missing(self, with_set = False):
+        '''Check out all extensions, and optionally this set, which are not
+        yet checked out, in a single transaction.
+        '''
+        tx = SysrootTransaction(self.repo)
+        queued = set()
         for ext in self.exts:
             dep_ext = ext.EXTENSION_PATH.joinpath(ext.get_id(), 'deploy')
-            deploy_aware(self.repo, ext.commit, dep_ext, ext.DEPLOY_PATH.joinpath(ext.get_id()))
+            cout = dep_ext.joinpath(f'{ext.commit}.0')
+            if cout not in queued and not cout.exists():
+                tx.checkout(ext.commit, dep_ext)
+                queued.add(cout)
+        if with_set and not checkout_is_full(self._deploy_space().joinpath(f'{self.ref}.0')):
+            tx.checkout(self.ref, self._deploy_space(), materialize=True)
+        tx.run()
+
+    @traced('deployment.boot_manifest')
+    def _write_boot_manifest(self, path: Path):
+        '''Record what early-boot needs to mount this set, so that it does
+        not have to open the repository or run plugins.
+        '''
+        cfs = composefs_is_enabled(self.repo)
+        exts = {}
+        for ext in self.exts:
+            cout = Path('/', ext.EXTENSION_PATH, ext.get_id(), 'deploy', f'{ext.commit}.0')
+            exts[ext.get_id()] = {
+                'id':        ext.get_id(),
+                'commit':    ext.commit,
+                'checkout':  str(cout),
+                'composefs': str(cout.joinpath('.ostree.cfs')) if cfs else None,
+                'verity':    composefs_digest(self.repo, ext.commit) if cfs else None
+            }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as f:
+            json.dump({ 'extensions': list(exts.values()) }, f)
+
+    def _read_state(self, path: Path) -> dict:
+        '''Load a JSON file from the state tree of the committed set.
+        '''
+        if self.ref is None:
+            return {}
+        try:
+            sfile = self.repo.read_commit(self.ref).out_root.resolve_relative_path(str(path))
+            return json.loads(sfile.load_contents().contents.decode())
+        except:
+            return {}
+
+    @traced('deployment.apply')
+    def apply(self, force = False, syslink = True, jobs = MOUNT_JOBS,
+              force_recheck = False) -> ApplyPlan:
+        '''Apply and replace the current deployment set with this one.
+        The new /run/extensions is prepared next to the current one, with up
+        to jobs images mounted concurrently beforehand, and swapped in with a
+        single atomic exchange, so that no partially applied state is ever
+        visible. Images are mounted once per commit: unchanged extensions
+        are not remounted, and unused images are unmounted afterwards.
+        Compatibility verdicts recorded at commit time are reused, including
+        warnings bypassed with force then, unless force_recheck is set.
+        Returns the plan that was executed.
+        '''
+        self._checkout_missing(with_set=True)
+        compat = {} if force_recheck else self._read_state(self.COMPAT_CACHE)
+        self._check_verdict(survey_compatible(self.root, self.exts, force, compat))
+
+        applied = read_applied()
+        plan = ApplyPlan(_applied_extensions(applied), self.exts)
+        targets = {}
+        with span('deployment.mount', exts=len(plan.swap + plan.mount)), \
+             MountExecutor(jobs) as mounts:
+            set_target = deploy_aware(self.repo, self.ref, self._deploy_space(), mounts)
+            for ext in self.exts:
+                dep_ext = ext.EXTENSION_PATH.joinpath(ext.get_id(), 'deploy')
+                try:
+                    targets[ext.get_id()] = deploy_aware(self.repo, ext.commit, dep_ext, mounts)
+                except Exception as e:
+                    plan.errors[ext.get_id()] = e
+            for mnt, e in mounts.wait().items():
+                Path(mnt).rmdir()
+                if Path(mnt) == set_target:
+                    raise OSError(f"Could not mount deployment set: {e}")
+                for id, target in targets.items():
+                    if target == Path(mnt):
+                        plan.errors[id] = e
+        for id, e in plan.errors.items():
+            error(f"Could not deploy extension '{id}': {e}")
+            targets.pop(id, None)
+
+        with span('deployment.switch'):
+            staged = self.DEPLOY_PATH.with_name(f'.{self.DEPLOY_PATH.name}.new')
+            staged.parent.mkdir(parents=True, exist_ok=True)
+            staged.unlink(missing_ok=True)
+            os.symlink(str(set_target), str(staged))
+            _swap_in(staged, self.DEPLOY_PATH)
+
+            staged = Extension.DEPLOY_PATH.with_name(f'.{Extension.DEPLOY_PATH.name}.new')
+            if os.path.lexists(staged):
+                _remove_tree(staged)    # Left over by an interrupted apply
+            staged.mkdir(parents=True)
+            for id, target in targets.items():
+                os.symlink(str(target), str(staged.joinpath(id)))
+            _swap_in(staged, Extension.DEPLOY_PATH)
+
+        write_applied(self.ref, { ext.get_id(): ext.commit for ext in self.exts
+                                  if ext.get_id() in targets })
+        self.record_applied()
+        _unmount_unused(set(targets.values()) | { set_target })
+        invalidate_mount_table()
 
-        sr = OSTree.Sysroot()
-        sr.load()
-        dep = sr.get_deployment_dirpath(self.root)
         if syslink:
-            os.symlink(f'../extensions/deploy/{self.ref}.0', f'{dep}.extensions')
+            sr = OSTree.Sysroot()
+            sr.load()
+            dep = Path(f'{sr.get_deployment_dirpath(self.root)}.extensions')
+            link = f'../extensions/deploy/{self.ref}.0'
+            if not (dep.is_symlink() and str(dep.readlink()) == link):
+                replace_symlink(link, dep)
+
+        info(f"Applied deployment set {self.ref}: {plan}")
+        if len(plan.errors) > 0:
+            raise OSError(f"{len(plan.errors)} extensions could not be deployed")
+        return plan
 
     def get_extensions(self) -> list[RepoExtension]:
         return self.exts
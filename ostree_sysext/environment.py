@@ -2,12 +2,13 @@ import os
 import pwd
 
 from logging        import error
-from mntfinder      import getMountPoint, getAllMountPoints
 from pathlib        import Path
 from dotenv         import dotenv_values
 
-from .systemd       import list_deployed, list_staged, refresh_sysexts
-from .repo          import RepoExtension, open_system_repo, find_sysext_refs
+from .systemd       import get_system_state, refresh_sysexts
+from .mounts        import get_mount_table
+from .repo          import RepoExtension, ExtensionIndex, open_system_repo, find_sysext_refs, \
+                           find_extension_ref, SCAN_WORKERS
 from .extensions    import Extension, DeployState
 from .deployment    import DeploymentSet
 
@@ -29,18 +30,16 @@ class MutableExtension(Extension):
     def get_version(self):
         return ""
 
-    def get_state(self):
-        mi = getMountPoint(Path('/', self.root))
+    def get_state(self, state = None):
         if not self.MUTABLE_BACKING_PATH.joinpath(self.root).exists():
             return DeployState.EXTERNAL
+        mi = get_mount_table().get(Path('/', self.root))
         if mi is None:
             return DeployState.INACTIVE
         if 'rw' in mi.options:
             return DeployState.ACTIVE
 
-        lower = list(filter(lambda o: o.startswith('lowerdir='), mi.options))[0]
-        lowerdirs = lower[len('lowerdir='):].split(':')
-        if str(Path('/', self.MUTABLE_DEPLOY_PATH, self.root)) in lowerdirs:
+        if str(Path('/', self.MUTABLE_DEPLOY_PATH, self.root)) in mi.lowerdirs:
             return DeployState.IMPORTED
         return DeployState.INACTIVE
 
@@ -81,26 +80,81 @@ class ExternalExtension(Extension):
             self.rel_info = dotenv_values(stream=f)
 
 
-def list_sysexts() -> list[Extension]:
-    '''Return a list of Extension objects discovered at the current root.
+def iter_sysexts(workers: int = SCAN_WORKERS):
+    '''Yield Extension objects discovered at the current root, each as soon
+    as it is resolved. Extensions from the repository come first.
     PWD needs to be the root we are operating in.
     '''
     repo = open_system_repo(Path('ostree'))
-    exts = [RepoExtension(repo, ref) for ref in find_sysext_refs(repo)]
-    repo_ids = [ex.get_id() for ex in exts]
-    staged_ids = list_staged()
-    deployed_ids = list_deployed()
+    index = ExtensionIndex(repo)
+    repo_ids = set()
+    for ref in find_sysext_refs(repo, index=index, workers=workers):
+        ext = RepoExtension(repo, ref, index)
+        repo_ids.add(ext.get_id())
+        yield ext
+    state = get_system_state()
+    staged_ids = state.staged
+    deployed_ids = state.deployed
 
     # is this even worth tracking?
     for id, dir in staged_ids.items():
         if id not in repo_ids:
-            exts.append(ExternalExtension(id, dir))
+            yield ExternalExtension(id, dir)
 
     for id in deployed_ids:
         if (id in staged_ids.keys()) or (id in repo_ids):
             continue
-        exts.append(ExternalExtension(id, '/'))
-    return exts
+        yield ExternalExtension(id, '/')
+
+def list_sysexts(workers: int = SCAN_WORKERS) -> list[Extension]:
+    '''Return a list of Extension objects discovered at the current root.
+    PWD needs to be the root we are operating in.
+    '''
+    return list(iter_sysexts(workers))
+
+def find_sysexts(ids: list[str], workers: int = SCAN_WORKERS) -> dict[str, Extension]:
+    '''Resolve extensions by id, without constructing every extension.
+    Repository extensions are looked up in their own ref namespace first,
+    and only ids missing from it cost a scan of the metadata index.
+    Ids which cannot be found are left out of the returned dict.
+    PWD needs to be the root we are operating in.
+    '''
+    found = {}
+    if any(id.startswith('mutable:') for id in ids):
+        found = { mut.get_id(): mut for mut in list_mutables() if mut.get_id() in ids }
+
+    repo = open_system_repo(Path('ostree'))
+    index = ExtensionIndex(repo)
+    for id in ids:
+        if id in found:
+            continue
+        ref = find_extension_ref(repo, id)
+        if ref is None:
+            continue
+        try:
+            ok, commit = repo.resolve_rev(ref, False)
+            if index.get(commit)['sysext'] and index.get(commit)['id'] == id:
+                found[id] = RepoExtension(repo, ref, index)
+        except:
+            pass    # Broken ref, let the full scan report it
+
+    missing = set(ids) - found.keys()
+    if len(missing) > 0:
+        for ref in find_sysext_refs(repo, index=index, workers=workers):
+            ok, commit = repo.resolve_rev(ref, False)
+            if index.get(commit)['id'] in missing:
+                found[index.get(commit)['id']] = RepoExtension(repo, ref, index)
+                missing.remove(index.get(commit)['id'])
+    index.save()
+
+    if len(missing) > 0:
+        state = get_system_state()
+        for id in missing:
+            if id in state.staged.keys():
+                found[id] = ExternalExtension(id, state.staged[id])
+            elif id in state.deployed:
+                found[id] = ExternalExtension(id, '/')
+    return found
 
 def list_mutables() -> list[MutableExtension]:
     '''Return a list of MutableExtension objects discovered at the current root.
@@ -108,16 +162,13 @@ def list_mutables() -> list[MutableExtension]:
     '''
     mutables = MutableExtension.MUTABLE_DEPLOY_PATH
     backing = MutableExtension.MUTABLE_BACKING_PATH
-    exts = []
-    if mutables.exists():
-        for mut in mutables.iterdir():
-            if not mut.name.startswith('.'):
-                exts.append(MutableExtension(mut.name))
-    if backing.exists():
-        for mut in backing.iterdir():
-            if mut.name not in [x.root for x in exts] and not mut.name.startswith('.'):
-                exts.append(MutableExtension(mut.name))
-    return exts
+    names = {}
+    for path in (mutables, backing):
+        if path.exists():
+            for mut in path.iterdir():
+                if not mut.name.startswith('.'):
+                    names[mut.name] = None
+    return [MutableExtension(name) for name in names.keys()]
 
 def get_current_deployment() -> DeploymentSet:
     '''Return the DeploymentSet for the active commit found under /run/ostree/extensions
@@ -128,9 +179,8 @@ def get_current_deployment() -> DeploymentSet:
     if deployset.is_symlink():
         commit = deployset.readlink().name[:-2]
     elif deployset.is_mount():
-        mp = getMountPoint(str(deployset))
-        lower = list(filter(lambda o: o.startswith('lowerdir+='), mp.options))[0]
-        commit = Path(lower).name[:-2]
+        mp = get_mount_table().get(deployset.absolute())
+        commit = Path(mp.lowerdirs[0]).name[:-2]
     else:
         raise ValueError("/run/ostree/extensions must be a symbolic link")
 
@@ -1,6 +1,12 @@
+import json
+
 from enum       import Enum
 from pathlib    import Path
 
+# Record of what was last deployed under Extension.DEPLOY_PATH, as composefs
+# mounts do not tell us which commit they come from.
+APPLIED_STATE_PATH = Path('/','run','ostree','.private','applied.json')
+
 class DeployState(Enum):
     '''List of possible deployment states for a given Extension.
     '''
@@ -50,8 +56,26 @@ class Extension:
     def get_rel_info(self):
         return self.rel_info
 
-    def get_state(self):
+    def get_state(self, state = None):
+        '''Return the DeployState of this extension. If given, state is the
+        systemd.SystemState snapshot to evaluate against.
+        '''
         return DeployState.EXTERNAL
 
     def get_root(self):
         raise NotImplemented()
+
+
+def read_applied() -> dict:
+    try:
+        with APPLIED_STATE_PATH.open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_applied(ref: str, commits: dict[str, str]):
+    '''Record the deployment set and extension commits that were deployed.
+    '''
+    APPLIED_STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with APPLIED_STATE_PATH.open('w') as f:
+        json.dump({ 'set': ref, 'extensions': commits }, f)
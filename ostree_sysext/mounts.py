@@ -0,0 +1,73 @@
+import re
+
+from pathlib        import Path
+
+MOUNTINFO_PATH = Path('/', 'proc', 'self', 'mountinfo')
+
+_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+def _unescape(field: str) -> str:
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountInfo:
+    '''A single entry of the mount table.
+    options holds the per-mount options, such as rw or ro for this mount
+    point, and super_options those of the filesystem, such as lowerdir.
+    '''
+    mountpoint: str
+    fstype: str
+    source: str
+    options: list[str]
+    super_options: list[str]
+    lowerdirs: list[str]
+
+    def __init__(self, line: str):
+        fields = line.split()
+        sep = fields.index('-')
+        self.mountpoint = _unescape(fields[4])
+        self.fstype = fields[sep + 1]
+        self.source = _unescape(fields[sep + 2])
+        self.options = fields[5].split(',')
+        self.super_options = fields[sep + 3].split(',')
+
+        self.lowerdirs = []
+        for opt in self.super_options:
+            if opt.startswith('lowerdir='):
+                self.lowerdirs += _unescape(opt[len('lowerdir='):]).split(':')
+            elif opt.startswith('lowerdir+='):
+                self.lowerdirs.append(_unescape(opt[len('lowerdir+='):]))
+
+
+class MountTable:
+    '''Index of the mount table by mount point, parsed once.
+    When mounts are stacked, the topmost one is kept.
+    '''
+    mounts: dict[str, MountInfo]
+
+    def __init__(self, path: Path = MOUNTINFO_PATH):
+        self.mounts = {}
+        with open(path) as f:
+            for line in f:
+                mi = MountInfo(line)
+                self.mounts[mi.mountpoint] = mi
+
+    def get(self, path) -> MountInfo:
+        return self.mounts.get(str(path))
+
+
+_mount_table: MountTable = None
+
+def get_mount_table() -> MountTable:
+    '''Return the MountTable for the current operation, parsing it if needed.
+    '''
+    global _mount_table
+    if _mount_table is None:
+        _mount_table = MountTable()
+    return _mount_table
+
+def invalidate_mount_table():
+    '''Drop the current MountTable, after mounts changed.
+    '''
+    global _mount_table
+    _mount_table = None
@@ -3,55 +3,154 @@ import os
 import sys
 import pkgutil
 import importlib
+import functools
 
 from logging                import warn, error
 from gi.repository          import OSTree
 from typing                 import Callable
 from pathlib                import Path
+from hashlib                import sha256
 
 from .extensions            import Extension, CompatVote
-from .sandbox               import edit_sandbox
+from .sandbox               import sandbox_session
+from .trace                 import span, traced
 
-def survey_compatible(root: OSTree.Deployment, exts: list[Extension], force=False) \
-        -> tuple[CompatVote, str]:
+@traced('plugins.check_compatible')
+def survey_compatible(root: OSTree.Deployment, exts: list[Extension], force=False,
+                      cache: dict = None) -> tuple[CompatVote, str]:
     '''Veto for sysext compatibility.
     Given a deployment root, and a set of enabled extensions, determine if the
     merged state does not give rise to conflicts.
+    If a cache dict is given, verdicts found there are reused instead of
+    running the plugin, and new verdicts are stored into it. Warnings which
+    were bypassed with force are recorded as such, and are not raised again
+    when the cached verdict is reused.
     '''
-    for plugin in _import_plugins('/usr/lib/ostree-sysext/plugins'):
-        res, msg = _call_sandbox(plugin.check_compatible, root, exts)
-        if res == CompatVote.WARN and force:
-            warn(f"{plugin.__name__}: {msg}")
-        elif res != CompatVote.APPROVE:
-            return res, f"{plugin.__name__}: {msg}"
+    plugins = list(_import_plugins('/usr/lib/ostree-sysext/plugins'))
+    keys = [compat_key(root, exts, plugin) for plugin in plugins]
+    if cache is None:
+        cache = {}
+    pending = [p.check_compatible for p, k in zip(plugins, keys) if k not in cache]
+
+    # All plugins without a cached verdict share a single sandbox
+    verdicts = _call_sandbox(pending, root, exts)
+    try:
+        for plugin, key in zip(plugins, keys):
+            forced = False
+            if key in cache:
+                vote, msg, *forced = cache[key]
+                res = CompatVote(vote)
+                forced = len(forced) > 0 and forced[0]
+            else:
+                res, msg = next(verdicts)
+            accepted = res == CompatVote.WARN and (force or forced)
+            cache[key] = (res.value, msg, True) if accepted else (res.value, msg)
+            if accepted:
+                warn(f"{plugin.__name__}: {msg}")
+            elif res != CompatVote.APPROVE:
+                return res, f"{plugin.__name__}: {msg}"
+    finally:
+        verdicts.close()
     return CompatVote.APPROVE, ""
 
+@traced('plugins.deploy_finish')
 def survey_deploy_finish(root: OSTree.Deployment, exts: list[Extension], tgt: Path, force=False) \
         -> tuple[CompatVote, str]:
     '''Commands to run to generate stateful files.
     You will be chroot'ed to the target sysroot, with all extensions merged.
     The work directory for the stateful commit will be in /run/ostree/extensions
-    and will be committed after all hooks finish.
+    and will be committed after all hooks finish. Subdirectories of state/
+    which are left absent are carried over unchanged from the previous set,
+    whose commit checksum is found in /run/ostree/extensions/parent.
     '''
-    for plugin in _import_plugins('/usr/lib/ostree-sysext/plugins'):
-        binds = { tgt: Path('/','run','ostree','extensions'),
-                 Path('/', 'sysroot'): Path('/', 'sysroot') }
-        res, msg = _call_sandbox(plugin.deploy_finish, root, exts, binds)
-        if res == CompatVote.WARN and force:
-            warn(f"{plugin.__name__}: {msg}")
-        elif res != CompatVote.APPROVE:
-            return res, f"{plugin.__name__}: msg"
+    plugins = list(_import_plugins('/usr/lib/ostree-sysext/plugins'))
+    binds = { tgt: Path('/','run','ostree','extensions'),
+             Path('/', 'sysroot'): Path('/', 'sysroot') }
+    verdicts = _call_sandbox([p.deploy_finish for p in plugins], root, exts, binds)
+    try:
+        for plugin, (res, msg) in zip(plugins, verdicts):
+            if res == CompatVote.WARN and force:
+                warn(f"{plugin.__name__}: {msg}")
+            elif res != CompatVote.APPROVE:
+                return res, f"{plugin.__name__}: {msg}"
+    finally:
+        verdicts.close()
     return CompatVote.APPROVE, ""
 
 
-def _call_sandbox(fn: Callable, root: OSTree.Deployment, exts: list[Extension], \
+def list_plugins() -> list[str]:
+    '''Names of the installed plugins. Each plugin owns the subdirectory of
+    the deployment set state/ tree of the same name.
+    '''
+    return [plugin.__name__ for plugin in _import_plugins('/usr/lib/ostree-sysext/plugins')]
+
+def plugin_identity(plugin) -> str:
+    '''Identify a plugin module by name, declared version and content.
+    '''
+    with open(plugin.__file__, 'rb') as f:
+        digest = sha256(f.read()).hexdigest()
+    return f"{plugin.__name__}-{getattr(plugin, '__version__', '')}-{digest[:16]}"
+
+def compat_key(root: OSTree.Deployment, exts: list[Extension], plugin) -> str:
+    '''Key for a compatibility verdict, from the base deployment checksum, the
+    ordered extension commits and the plugin identity.
+    '''
+    h = sha256(root.get_csum().encode())
+    for ext in exts:
+        h.update(ext.commit.encode())
+    h.update(plugin_identity(plugin).encode())
+    return h.hexdigest()
+
+def hash_tree(path: Path) -> str:
+    '''Hash the names and contents of all files below a directory.
+    Only meant for small trees, such as configuration directories.
+    '''
+    if not path.is_dir():
+        return "absent"
+    h = sha256()
+    for f in sorted(p for p in path.rglob('*') if p.is_file()):
+        h.update(str(f.relative_to(path)).encode())
+        h.update(f.read_bytes())
+    return h.hexdigest()
+
+def set_key(root: OSTree.Deployment, exts: list[Extension]) -> str:
+    '''Content key for a deployment set, from the base deployment checksum,
+    the ordered extension commits and the identity of every plugin.
+    Plugins may list local paths of the deployment their state depends on,
+    such as configuration in /etc, in STATE_INPUTS.
+    Two sets with the same key have the same plugin-generated state.
+    '''
+    h = sha256(root.get_csum().encode())
+    for ext in exts:
+        h.update(ext.commit.encode())
+    inputs = []
+    for plugin in _import_plugins('/usr/lib/ostree-sysext/plugins'):
+        h.update(plugin_identity(plugin).encode())
+        inputs += getattr(plugin, 'STATE_INPUTS', [])
+    if len(inputs) > 0:
+        sr = OSTree.Sysroot()
+        sr.open()
+        base = Path(sr.get_deployment_dirpath(root))
+        for path in inputs:
+            h.update(f"{path}={hash_tree(base.joinpath(path))}".encode())
+    return h.hexdigest()
+
+
+def _call_sandbox(fns: list[Callable], root: OSTree.Deployment, exts: list[Extension], \
                   binds: dict[Path, Path] = None):
+    if len(fns) == 0:
+        return sandbox_session([], [])
     sr = OSTree.Sysroot()
     sr.open()
     layers = [sr.get_deployment_dirpath(root)]
     for ext in exts:
         layers.append(ext.get_root())
-    return edit_sandbox(lambda: fn(root, exts), layers, binds=binds)
+    return sandbox_session([functools.partial(_run_plugin, fn, root, exts) for fn in fns],
+                           layers, binds=binds)
+
+def _run_plugin(fn: Callable, root: OSTree.Deployment, exts: list[Extension]):
+    with span('plugin', plugin=fn.__module__, hook=fn.__name__):
+        return fn(root, exts)
 
 def _import_plugins(plugpath: str):
     oldpath = sys.path.copy()
@@ -1,20 +1,34 @@
 import os
 import gi
+import json
 
 gi.require_version('OSTree', '1.0')
 
-from gi.repository  import OSTree, Gio
+from gi.repository  import OSTree, Gio, GLib
 from pathlib        import Path
 from dotenv         import dotenv_values
 from io             import StringIO
-from logging        import warn
+from tempfile       import mkstemp
+from threading      import local
+from typing         import Callable
+from concurrent.futures import ThreadPoolExecutor
+from logging        import warn, debug
 
-from .systemd       import list_staged, list_deployed
+from .systemd       import SystemState, get_system_state
 from .extensions    import Extension, DeployState
-from .sandbox       import mount, umount, edit_sysroot, mount_composefs
+from .sandbox       import mount, umount, edit_sysroot, mount_composefs, report_progress, \
+                           MountExecutor, COMPOSEFS_MOUNTS, AT_FDCWD
+from .trace         import span, traced
 
 NOFLAGS = Gio.FileQueryInfoFlags.NONE
 
+# Upper bound for concurrent commit reads, as ref scanning is I/O bound
+SCAN_WORKERS = min(8, os.cpu_count() or 1)
+
+# Extensions are pinned to refs named <EXTENSION_REFS>/<id>/<serial>
+EXTENSION_REFS = 'ostree/extension'
+
+@traced('repo.open')
 def open_system_repo(path: str) -> OSTree.Repo:
     '''Returns the OSTree Repo object for the given repository, setting up
     deployment areas for sysext if not already done
@@ -60,18 +74,199 @@ def ref_is_deployment_set(commit) -> bool:
 
     return True
 
-def find_sysext_refs(repo: OSTree.Repo, prefix = None):
+def commit_metadata(meta: dict) -> GLib.Variant:
+    '''Convert a dict to commit metadata. Strings are stored as is, and
+    other values as JSON strings.
+    '''
+    return GLib.Variant('a{sv}', { k: GLib.Variant('s', v if type(v) is str else json.dumps(v))
+                                   for k, v in meta.items() })
+
+def read_commit_metadata(repo: OSTree.Repo, commit: str, key: str) -> str:
+    '''Return a string from the metadata of a commit, or None if unset.
+    '''
+    ok, commitv, _s = repo.load_commit(commit)
+    value = commitv.get_child_value(0).lookup_value(key, GLib.VariantType.new('s'))
+    return value.get_string() if value is not None else None
+
+def read_sysext_info(repo: OSTree.Repo, commit: str) -> dict:
+    '''Read the metadata we need to know about a commit, given its checksum.
+    This is the expensive path which ExtensionIndex caches.
+    '''
+    res = repo.read_commit(commit)
+    if not ref_is_sysext(res):
+        return { 'sysext': False }
+
+    info = { 'sysext': True, 'builder': None, 'build_context': None }
+    builder = read_commit_metadata(repo, res.out_commit, 'ostree-sysext.builder')
+    if builder is not None:
+        info['builder'] = builder
+        info['build_context'] = json.loads(
+            read_commit_metadata(repo, res.out_commit, 'ostree-sysext.build-context'))
+
+    ext_rel = res.out_root \
+                 .get_child('usr').get_child('lib') \
+                 .get_child('extension-release.d')
+    rel_name = list(ext_rel.enumerate_children("standard::*", NOFLAGS))[0].get_name()
+    rel_file = ext_rel.get_child(rel_name)
+    info['id'] = rel_name[len("extension-release."):]
+    info['rel_info'] = dotenv_values(stream=StringIO(rel_file.load_contents().contents.decode()))
+    return info
+
+
+class RepoIndex:
+    '''On-disk JSON cache stored alongside the repository, which is only
+    written back if it changed.
+    '''
+    INDEX_PATH: Path
+
+    repo: OSTree.Repo
+    path: Path
+    entries: dict[str, dict]
+    dirty: bool
+
+    def __init__(self, repo: OSTree.Repo):
+        self.repo = repo
+        self.path = Path(repo.get_path().get_path(), self.INDEX_PATH)
+        self.entries = {}
+        self.dirty = False
+        try:
+            with self.path.open() as f:
+                self.entries = json.load(f)['commits']
+        except (OSError, ValueError, KeyError):
+            pass    # Missing or corrupt index, it will be rebuilt as we go
+
+    def clear(self):
+        self.entries = {}
+        self.dirty = True
+
+    def save(self):
+        '''Write the index back to the repository if it changed.
+        This is best-effort, as a read-only caller still gets correct results.
+        '''
+        if not self.dirty:
+            return
+        try:
+            self._write()
+        except OSError:
+            if os.geteuid() != 0:
+                debug("Not saving index, repository is read-only")
+                return
+            err, _ = edit_sysroot(lambda: (0, self._write()))
+            if err:
+                warn(f"Could not save index {self.INDEX_PATH.name}")
+                return
+        self.dirty = False
+
+    def _write(self) -> str:
+        '''Replace the index atomically, through a temporary file of its own,
+        as the daemon and the command line may save it concurrently.
+        '''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = mkstemp(prefix=f'.{self.path.name}.', dir=self.path.parent)
+        try:
+            os.fchmod(fd, 0o644)    # Readable by unprivileged listing
+            with os.fdopen(fd, 'w') as f:
+                json.dump({ 'commits': self.entries }, f)
+            os.replace(tmp, self.path)
+        except:
+            os.unlink(tmp)
+            raise
+        return ""
+
+
+class ExtensionIndex(RepoIndex):
+    '''On-disk cache of sysext metadata, keyed by commit checksum.
+    Commits are immutable, so an entry can never go stale: only commits
+    we have never seen before need to be read from the repository.
+    '''
+    INDEX_PATH = Path('extensions', 'ostree-sysext', 'index.json')
+
+    def get(self, commit: str) -> dict:
+        '''Return the metadata for a commit checksum, reading the commit
+        only if it was not indexed yet.
+        '''
+        if commit not in self.entries:
+            self.entries[commit] = read_sysext_info(self.repo, commit)
+            self.dirty = True
+        return self.entries[commit]
+
+    def scan(self, commits, workers: int = SCAN_WORKERS):
+        '''Yield the given commits in order, each as soon as it is indexed,
+        while those missing from the index are read concurrently, using one
+        repository handle per worker thread.
+        Commits which cannot be read are left out, for get() to report.
+        '''
+        commits = list(commits)
+        # Read in the order commits are yielded, so the first ones come first
+        missing = list(dict.fromkeys(c for c in commits if c not in self.entries))
+        if len(missing) == 0:
+            yield from commits
+            return
+        path = self.repo.get_path()
+        handles = local()
+
+        def read(commit: str):
+            if not hasattr(handles, 'repo'):
+                handles.repo = OSTree.Repo.new(path)
+                handles.repo.open()
+            try:
+                return read_sysext_info(handles.repo, commit)
+            except:
+                return None
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = { commit: pool.submit(read, commit) for commit in missing }
+            for commit in commits:
+                if commit in futures:
+                    info = futures.pop(commit).result()
+                    if info is not None:
+                        self.entries[commit] = info
+                        self.dirty = True
+                yield commit
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def find_sysext_refs(repo: OSTree.Repo, prefix = None, index: ExtensionIndex = None,
+                     workers: int = 1):
     '''Inspect local refs for sysext metadata in their embedded tree.
+    With more than one worker, unindexed commits are read concurrently, and
+    each ref is yielded as soon as its own commit was read.
+    Refs are always yielded in the order returned by list_refs.
     '''
-    success, refs = repo.list_refs(prefix)
-    for ref in refs.keys():
+    if index is None:
+        index = ExtensionIndex(repo)
+    with span('repo.list_refs', prefix=prefix):
+        success, refs = repo.list_refs_ext(prefix, OSTree.RepoListRefsExtFlags.NONE, None)
+    commits = index.scan(refs.values(), workers) if workers > 1 else refs.values()
+    for (ref, commit), _ in zip(refs.items(), commits):
         try:
-            if ref_is_sysext(repo.read_commit(ref)):
+            if index.get(commit)['sysext']:
                 yield ref
         except:
             warn(f"Could not open ref \"{ref}\" for analysis")
             pass    # rpm-ostree sometimes keeps broken refs that can trip
                     # up the detector due to missing metadata
+    index.save()
+
+def extension_ref(id: str, serial: int = 0) -> str:
+    return f'{EXTENSION_REFS}/{id}/{serial}'
+
+def find_extension_ref(repo: OSTree.Repo, id: str) -> str:
+    '''Return the ref pinning the extension with the given id, looking only
+    under its own ref namespace. Serial 0 is preferred if there are several.
+    Returns None if the namespace holds no ref.
+    '''
+    try:
+        with span('repo.list_refs', prefix=f'{EXTENSION_REFS}/{id}'):
+            ok, refs = repo.list_refs_ext(f'{EXTENSION_REFS}/{id}',
+                                          OSTree.RepoListRefsExtFlags.NONE, None)
+    except GLib.Error:
+        return None
+    if extension_ref(id) in refs:
+        return extension_ref(id)
+    return min(refs.keys(), default=None)
 
 def composefs_is_enabled(repo: OSTree.Repo) -> bool:
     '''Check whether composefs is enabled in the OSTree repository.
@@ -83,38 +278,100 @@ def composefs_is_enabled(repo: OSTree.Repo) -> bool:
     except:
         return False
 
-def checkout_aware(repo: OSTree.Repo, ref: str, dest: str):
-    '''Checkout ref into given space, while cleaning up previous deployments
-    and generating composefs metadata if enabled.
+def composefs_digest(repo: OSTree.Repo, commit: str) -> str:
+    '''Return the expected fs-verity digest of the composefs image for a
+    commit as a hex string, or None if the commit does not record one.
+    '''
+    ok, commitv, _s = repo.load_commit(commit)
+    digest = commitv.get_child_value(0).lookup_value('ostree.composefs.digest.v0', None)
+    if digest is None:
+        return None
+    return bytes(digest.unpack()).hex()
+
+def checkout_is_full(path: Path) -> bool:
+    '''Whether a checkout holds the full tree, rather than only its composefs
+    image.
+    '''
+    return path.exists() and any(ent.name != '.ostree.cfs' for ent in path.iterdir())
+
+@traced('repo.checkout')
+def checkout_aware(repo: OSTree.Repo, ref: str, dest: str, materialize = False):
+    '''Checkout ref into given space, generating composefs metadata if enabled.
+    With composefs, only the image is written into an otherwise empty
+    directory, as mounting it reads file contents from the repository.
+    If materialize is set, the full tree is checked out regardless, next to
+    an existing image if there is one.
     '''
-    opts = OSTree.RepoCheckoutAtOptions()
-    opts.enable_uncompressed_cache = True
-
     local, _r, commit = repo.read_commit(ref)
     destpath = Path(dest, f'{commit}.0')
-    rfd = os.open(repo.get_path().get_path(), os.O_RDONLY)
-    repo.checkout_at(opts, rfd, str(destpath), commit)
-    if composefs_is_enabled(repo):
-        wr = OSTree.Repo.new(repo.get_path())
-        wr.open()
-        wr.checkout_composefs(None, rfd, str(destpath.joinpath('.ostree.cfs')), commit)
+    Path(dest).mkdir(parents=True, exist_ok=True)
+    cfs = composefs_is_enabled(repo)
+    if materialize or not cfs:
+        opts = OSTree.RepoCheckoutAtOptions()
+        opts.enable_uncompressed_cache = True
+        if destpath.exists():
+            opts.overwrite_mode = OSTree.RepoCheckoutOverwriteMode.ADD_FILES
+        repo.checkout_at(opts, AT_FDCWD, str(destpath), commit)
+    if cfs and not destpath.joinpath('.ostree.cfs').exists():
+        destpath.mkdir(exist_ok=True)
+        with span('repo.composefs', commit=commit):
+            repo.checkout_composefs(None, AT_FDCWD, str(destpath.joinpath('.ostree.cfs')), commit)
     return ""
 
-def deploy_aware(repo: OSTree.Repo, ref: str, prefix: Path, dest: Path):
-    '''Perform checkout checks, and deploy ref to target directory while
-    applying composefs if present.
+def deploy_aware(repo: OSTree.Repo, ref: str, prefix: Path,
+                 mounts: MountExecutor = None) -> Path:
+    '''Perform checkout checks, and return the absolute path to deploy ref
+    from, mounting its composefs image first if present.
+    Images are mounted once per commit under COMPOSEFS_MOUNTS. If a
+    MountExecutor is given, the mount is queued onto it, keyed by the
+    returned path, instead of being performed immediately.
     '''
     local, _r, commit = repo.read_commit(ref)
     coutpath = Path(prefix, f'{commit}.0')
     if not coutpath.exists():
         edit_sysroot(lambda: (0, checkout_aware(repo, ref, prefix)))
-    if coutpath.joinpath('.ostree.cfs').exists():
-        dest.mkdir(parents=True, exist_ok=True)
-        mount_composefs(coutpath.joinpath('.ostree.cfs'), dest)
+    if not coutpath.joinpath('.ostree.cfs').exists():
+        return coutpath.absolute()
+
+    mnt = COMPOSEFS_MOUNTS.joinpath(f'{commit}.0')
+    if mnt.is_mount() or (mounts is not None and str(mnt) in mounts.pending):
+        return mnt
+    mnt.mkdir(parents=True, exist_ok=True)
+    if mounts is not None:
+        mounts.submit(str(mnt), coutpath.joinpath('.ostree.cfs'), mnt)
     else:
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        os.symlink(str(coutpath), str(dest))
-
+        mount_composefs(coutpath.joinpath('.ostree.cfs'), mnt)
+    return mnt
+
+
+@traced('repo.commit')
+def write_commit_dir(wr: OSTree.Repo, dir: Path, parent: str = None, \
+        subject: str = None, body: str = None, meta: dict = None, \
+        overlay: list[str] = None) -> str:
+    '''Write a given directory as a commit, within an open transaction.
+    If overlay is set, the commit is built on top of the parent's tree: only
+    the listed subdirectories are replaced by those found in dir, and the
+    rest of the parent tree is reused without being read or hashed again.
+    '''
+    if overlay is not None and parent is not None:
+        mtree = OSTree.MutableTree.new_from_commit(wr, parent)
+        for sub in overlay:
+            parts = Path(sub).parts
+            subtree = mtree
+            for part in parts[:-1]:
+                ok, subtree = subtree.ensure_dir(part)
+            subtree.remove(parts[-1], True)
+            if Path(dir, sub).is_dir():
+                ok, child = subtree.ensure_dir(parts[-1])
+                wr.write_directory_to_mtree(Gio.File.new_for_path(str(Path(dir, sub))),
+                                            child, None)
+    else:
+        mtree = OSTree.MutableTree()
+        wr.write_directory_to_mtree(Gio.File.new_for_path(str(dir)), mtree, None)
+    done, mr = wr.write_mtree(mtree)
+    done, ref = wr.write_commit(parent, subject, body,
+                                commit_metadata(meta) if meta is not None else None, mr)
+    return ref
 
 def commit_dir(repo: OSTree.Repo, dir: Path, parent: str = None, \
         subject: str = None, body: str = None, meta: dict = None) -> str:
@@ -123,59 +380,165 @@ def commit_dir(repo: OSTree.Repo, dir: Path, parent: str = None, \
     wr = OSTree.Repo.new(repo.get_path())
     wr.open()
     wr.prepare_transaction()
-    mtree = OSTree.MutableTree()
-    wr.write_directory_to_mtree(Gio.File.new_for_path(str(dir)), mtree)
-    done, mr = wr.write_mtree(mtree)
-    done, ref = wr.write_commit(parent, subject, body, meta, mr)
+    ref = write_commit_dir(wr, dir, parent, subject, body, meta)
     wr.commit_transaction()
     return ref
 
 def pin_ref(repo: OSTree.Repo, commit: str, ref: str):
     '''Take a commit hash and pin it to a branch
     '''
-    ret, val = edit_sysroot(repo.set_ref_immediate(None, ref, commit))
+    ret, val = edit_sysroot(lambda: (0, repo.set_ref_immediate(None, ref, commit)))
     if ret == 0:
         return val
     else:
         raise OSError(ret)
 
 
+class SysrootTransaction:
+    '''Batch of privileged repository operations.
+    Operations are queued, then run together in a single edit_sysroot()
+    child, within one OSTree transaction. Ref updates only take effect,
+    atomically, once the whole transaction is committed.
+
+    Each queueing method returns the index of its result in the list
+    returned by run(), which can be passed to later operations in place
+    of a commit checksum.
+    '''
+    repo: OSTree.Repo
+    ops: list[Callable]
+
+    def __init__(self, repo: OSTree.Repo):
+        self.repo = repo
+        self.ops = []
+
+    def _queue(self, op: Callable) -> int:
+        self.ops.append(op)
+        return len(self.ops) - 1
+
+    def checkout(self, ref, dest: Path, materialize = False) -> int:
+        '''Queue a checkout_aware() of ref into dest.
+        '''
+        return self._queue(lambda wr, res: checkout_aware(wr, _resolve(ref, res), dest,
+                                                          materialize))
+
+    def commit(self, dir: Path, parent = None, subject: str = None,
+               body: str = None, meta: dict = None, overlay: list[str] = None) -> int:
+        '''Queue a commit of dir, whose result is the new commit checksum.
+        See write_commit_dir() for overlay.
+        '''
+        return self._queue(lambda wr, res: write_commit_dir(wr, dir, _resolve(parent, res),
+                                                            subject, body, meta,
+                                                            overlay))
+
+    def set_ref(self, ref: str, commit) -> int:
+        '''Queue pointing ref to commit, when the transaction is committed.
+        '''
+        return self._queue(lambda wr, res: wr.transaction_set_ref(None, ref, _resolve(commit, res)))
+
+    def _run(self) -> tuple[int, list]:
+        wr = OSTree.Repo.new(self.repo.get_path())
+        wr.open()
+        results = []
+        wr.prepare_transaction()
+        try:
+            for op in self.ops:
+                results.append(op(wr, results))
+            wr.commit_transaction()
+        except:
+            wr.abort_transaction()
+            raise
+        return 0, results
+
+    def run(self) -> list:
+        '''Run all queued operations, and return their results in order.
+        '''
+        if len(self.ops) == 0:
+            return []
+        with span('repo.transaction', ops=len(self.ops)):
+            err, results = edit_sysroot(self._run)
+        if err:
+            raise OSError(err)
+        self.ops = []
+        return results
+
+def _resolve(ref, results: list):
+    return results[ref] if type(ref) is int else ref
+
+
+def _on_pull_progress(progress: OSTree.AsyncProgress, remote: str):
+    report_progress({ 'remote':      remote,
+                      'fetched':     progress.get_uint('fetched'),
+                      'requested':   progress.get_uint('requested'),
+                      'bytes':       progress.get_uint64('bytes-transferred'),
+                      'delta-parts': progress.get_uint('fetched-delta-parts'),
+                      'total-parts': progress.get_uint('total-delta-parts') })
+
+@traced('repo.pull')
+def pull_refs(repo: OSTree.Repo, remote: str, refs: list[str]) -> dict[str, str]:
+    '''Pull all given refs from a remote in a single operation.
+    Static deltas are used whenever the remote provides them, and aggregated
+    progress is reported for the whole batch. Returns the pulled commits.
+    Requires write access to the repository.
+    '''
+    opts = GLib.Variant('a{sv}', {
+        'refs':                  GLib.Variant('as', refs),
+        'flags':                 GLib.Variant('i', int(OSTree.RepoPullFlags.NONE)),
+        'disable-static-deltas': GLib.Variant('b', False)
+    })
+    progress = OSTree.AsyncProgress.new()
+    progress.connect('changed', _on_pull_progress, remote)
+    try:
+        repo.pull_with_options(remote, opts, progress, None)
+    finally:
+        progress.finish()
+
+    pulled = {}
+    for ref in refs:
+        ok, pulled[ref] = repo.resolve_rev(f'{remote}:{ref}', False)
+    return pulled
+
+
 class RepoExtension(Extension):
     EXTENSION_PATH = Path('ostree','extensions')
 
     repo: OSTree.Repo
     commit: str
-    root: OSTree.RepoFile
+    origin: str
     rel_info: dict
     id: str
     builder: str
     build_context: dict
 
-    def __init__(self, repo: OSTree.Repo, ref: str):
-        commit = repo.read_commit(ref)
-        if not ref_is_sysext(commit):
-            raise ValueError("Specified ref is not a valid OSTree sysext")
-        self.root = commit.out_root
+    def __init__(self, repo: OSTree.Repo, ref: str, index: ExtensionIndex = None):
+        '''Construct a RepoExtension from a ref or commit checksum.
+        If an index is given, metadata is looked up there instead of
+        reading the commit.
+        '''
+        ok, self.commit = repo.resolve_rev(ref, False)
+        self.origin = ref if ref != self.commit else None
         self.repo = repo
-        self.commit = commit.out_commit
-
-        res, meta = repo.read_commit_detached_metadata(self.commit)
-        if meta is not None and 'ostree-sysext.builder' in meta.keys():
-            self.builder = meta['ostree-sysext.builder']
-            self.build_context = meta['ostree-sysext.build-context']
-
-        ext_rel = commit.out_root \
-                        .get_child('usr').get_child('lib') \
-                        .get_child('extension-release.d')
-        rel_name = list(ext_rel.enumerate_children("standard::*", NOFLAGS))[0].get_name()
-        rel_file = ext_rel.get_child(rel_name)
-        self.id = rel_name[len("extension-release."):]
-        self.rel_info = dotenv_values(stream=StringIO(rel_file.load_contents().contents.decode()))
-
-    def get_state(self):
-        staged = self.id in list_staged().keys()
-        deployed = self.id in list_deployed()
-        osrel = None
+        if index is not None:
+            info = index.get(self.commit)
+        else:
+            info = read_sysext_info(repo, self.commit)
+        if not info['sysext']:
+            raise ValueError("Specified ref is not a valid OSTree sysext")
+
+        self.id = info['id']
+        self.rel_info = info['rel_info']
+        self.builder = info['builder']
+        self.build_context = info['build_context']
+
+    @property
+    def root(self) -> OSTree.RepoFile:
+        return self.repo.read_commit(self.commit).out_root
+
+    def get_state(self, state: SystemState = None):
+        if state is None:
+            state = get_system_state()
+        staged = self.id in state.staged.keys()
+        deployed = self.id in state.deployed
+        osrel = state.os_release
         if staged and deployed:
             return DeployState.ACTIVE
         elif staged:
@@ -183,8 +546,6 @@ class RepoExtension(Extension):
         elif deployed:
             return DeployState.UNSTAGED
 
-        with open('etc/os-release') as osrf:
-            osrel = dotenv_values(stream=osrf)
         if self.rel_info['ID'] != osrel['ID'] and self.rel_info['ID'] != '_any':
             return DeployState.INCOMPAT
         elif 'ARCHITECTURE' in self.rel_info.keys() \
@@ -199,9 +560,20 @@ class RepoExtension(Extension):
     def get_rel_info(self):
         return self.rel_info
 
-    def get_root(self) -> Path:
-        mypath = self.EXTENSION_PATH.joinpath(self.id, 'deploy')
-        if not mypath.joinpath(f'{self.commit}.0').exists():
-            checkout_aware(self.repo, self.commit, mypath)
-        return mypath.joinpath(f'{self.commit}.0')
+    def checkout_path(self) -> Path:
+        return self.EXTENSION_PATH.joinpath(self.id, 'deploy', f'{self.commit}.0')
+
+    def deploy_path(self) -> Path:
+        '''Absolute path this extension is deployed from: the mount point of
+        its composefs image if enabled, otherwise its checkout.
+        '''
+        if composefs_is_enabled(self.repo):
+            return COMPOSEFS_MOUNTS.joinpath(f'{self.commit}.0')
+        return Path('/', self.checkout_path())
 
+    def get_root(self) -> Path:
+        '''Return a directory holding the tree of this extension, checking it
+        out if needed. With composefs, its image is mounted rather than
+        checked out in full, so this requires root privileges.
+        '''
+        return deploy_aware(self.repo, self.commit, self.checkout_path().parent)
@@ -1,29 +1,52 @@
+import io
 import os
 import sys
 import pwd
+import pickle
+import struct
+import builtins
 
-from ctypes         import CDLL, POINTER, Structure, c_char_p, c_int, c_uint32, c_ulong, c_size_t, get_errno
+from ctypes         import CDLL, POINTER, Structure, c_char_p, c_int, c_uint, c_uint32, c_ulong, c_size_t, get_errno
 from ctypes.util    import find_library
 from typing         import Callable
 from pathlib        import Path
-from logging        import error
+from logging        import error, debug
 from tempfile       import mkdtemp
 from functools      import reduce
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .trace         import span, traced, get_tracer
 
 
 libc = CDLL(find_library('c'), use_errno=True)
 libc.mount.argtypes = (c_char_p, c_char_p, c_char_p, c_ulong, c_char_p)
-libc.umount.argtypes = (c_char_p,)
+libc.umount2.argtypes = (c_char_p, c_int)
+libc.renameat2.argtypes = (c_int, c_char_p, c_int, c_char_p, c_uint)
 
 MS_RDONLY   = 1 << 0
 MS_REMOUNT  = 1 << 5
 MS_BIND     = 1 << 12
 
+MNT_DETACH  = 1 << 1
+
+AT_FDCWD        = -100
+RENAME_EXCHANGE = 1 << 1
+
 LCFS_MOUNT_FLAGS_REQUIRE_VERITY = 1 << 0
 LCFS_MOUNT_FLAGS_READONLY       = 1 << 1
 LCFS_MOUNT_FLAGS_IDMAP          = 1 << 3
 LCFS_MOUNT_FLAGS_TRY_VERITY     = 1 << 4
 
+# composefs images are mounted once per commit, as <commit>.0, and deployed
+# by linking to their mount point
+COMPOSEFS_MOUNTS = Path('/', 'run', 'ostree', '.private', 'mounts')
+
+# Unprivileged user running plugins and builders
+SANDBOX_USER = "ostree-sysext"
+
+# Number of composefs images to mount concurrently
+MOUNT_JOBS = int(os.getenv('OSTREE_SYSEXT_MOUNT_JOBS', os.cpu_count() or 1))
+
 class CFSOpts(Structure):
     _fields_ = [('objdirs', POINTER(c_char_p)),
                 ('n_objdirs', c_size_t),
@@ -41,14 +64,40 @@ def mount(what, where, fs, opts):
         error(f"mount({where}): {os.strerror(get_errno())}")
         raise OSError(get_errno())
 
-def umount(what):
-    if libc.umount(str(what).encode()):
+def umount(what, flags = 0):
+    if libc.umount2(str(what).encode(), flags):
         error(f"umount({what}): {os.strerror(get_errno())}")
         raise OSError(get_errno())
 
+def exchange(a, b):
+    '''Atomically swap two existing paths, of any type.
+    '''
+    if libc.renameat2(AT_FDCWD, str(a).encode(), AT_FDCWD, str(b).encode(), RENAME_EXCHANGE):
+        error(f"renameat2({a}, {b}): {os.strerror(get_errno())}")
+        raise OSError(get_errno())
+
+def replace_symlink(target, link: Path):
+    '''Atomically point link to target, replacing any previous symlink.
+    '''
+    tmp = link.with_name(f'.{link.name}.tmp')
+    tmp.unlink(missing_ok=True)
+    os.symlink(str(target), str(tmp))
+    os.replace(tmp, link)
+
+_libcfs: CDLL = None
+
+def load_composefs() -> CDLL:
+    '''Load libcomposefs, once per process.
+    '''
+    global _libcfs
+    if _libcfs is None:
+        _libcfs = CDLL(find_library('composefs'), use_errno=True)
+        _libcfs.lcfs_mount_image.argtypes = (c_char_p, c_char_p, POINTER(CFSOpts))
+    return _libcfs
+
+@traced('mount.composefs')
 def mount_composefs(img, where, verity: bytes = None, idmap: Path = None):
-    libcfs = CDLL(find_library('composefs'), use_errno=True)
-    libcfs.lcfs_mount_image.argtypes = (c_char_p, c_char_p, POINTER(CFSOpts))
+    libcfs = load_composefs()
 
     tmpdir = Path('/', 'run', 'ostree', '.private', *img.parts[2:-1])
     tmpdir.mkdir(parents=True, exist_ok=True)
@@ -72,96 +121,281 @@ def mount_composefs(img, where, verity: bytes = None, idmap: Path = None):
         raise OSError(get_errno())
 
 
-def edit_sysroot(fn: Callable) -> tuple[int, str]:
-    '''Run a process in the bare root with read/write access.
-    Useful for working on an OSTree deployment root.
-    Requires root privileges.
+class MountExecutor:
+    '''Mount independent composefs images concurrently.
+    Errors are collected per image rather than aborting on the first one,
+    and are available from wait() once all mounts are done.
+    '''
+    pool: ThreadPoolExecutor
+    pending: dict[str, Future]
+
+    def __init__(self, jobs: int = MOUNT_JOBS):
+        load_composefs()
+        self.pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        self.pending = {}
+
+    def submit(self, key: str, img, where, verity: bytes = None, idmap: Path = None):
+        self.pending[key] = self.pool.submit(mount_composefs, img, where, verity, idmap)
+
+    def wait(self) -> dict[str, Exception]:
+        errors = {}
+        for key, fut in self.pending.items():
+            try:
+                fut.result()
+            except Exception as e:
+                errors[key] = e
+        self.pending = {}
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(wait=True)
+
+
+# Builtins which frames may reference: exceptions and plain containers
+SAFE_BUILTINS = { name for name, obj in vars(builtins).items()
+                  if isinstance(obj, type) and issubclass(obj, BaseException) } \
+              | { 'set', 'frozenset', 'bytearray', 'complex', 'range', 'slice' }
+# Other classes which frames may reference
+SAFE_CLASSES = { ('ostree_sysext.extensions', 'CompatVote'),
+                 ('ostree_sysext.extensions', 'UpdateState') }
+
+class FrameUnpickler(pickle.Unpickler):
+    '''Unpickler which only rebuilds plain data, builtin exceptions and
+    verdict enums, as frames may come from a sandboxed child running
+    untrusted code, while the parent is privileged.
     '''
+    def find_class(self, module: str, name: str):
+        if module == 'builtins' and name in SAFE_BUILTINS:
+            return getattr(builtins, name)
+        if (module, name) in SAFE_CLASSES:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from child process")
+
+
+class ResultChannel:
+    '''Framed, streaming result protocol between a forked child and its parent.
+    Each frame is a 4-byte big-endian length followed by a pickled
+    (kind, payload) tuple, so that results of any size can be returned
+    while the child is still running. Frames are read with FrameUnpickler,
+    so exceptions of other types are sent as a RuntimeError.
+    '''
+    RESULT   = 0  # Return value of a function
+    ERROR    = 1  # Exception raised by a function
+    PROGRESS = 2  # Freeform progress event
+    SPANS    = 3  # Timing spans finished in the child, see trace.Tracer
+
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, fd: int, mode: str):
+        self.file = os.fdopen(fd, mode)
+
+    def send(self, kind: int, payload):
+        if kind == self.ERROR and type(payload).__module__ != 'builtins':
+            payload = RuntimeError(f"{type(payload).__name__}: {payload}")
+        try:
+            data = pickle.dumps((kind, payload))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            data = pickle.dumps((self.ERROR, RuntimeError(f"Unpicklable result: {payload!r}")))
+        self.file.write(self.HEADER.pack(len(data)) + data)
+        self.file.flush()
+
+    def frames(self):
+        while True:
+            head = self.file.read(self.HEADER.size)
+            if len(head) < self.HEADER.size:
+                return
+            size, = self.HEADER.unpack(head)
+            data = self.file.read(size)
+            if len(data) < size:
+                return  # Child died mid-frame
+            yield FrameUnpickler(io.BytesIO(data)).load()
+
+    def close(self):
+        self.file.close()
+
+# Set in forked children, so that functions can report progress to the parent
+_channel: ResultChannel = None
+
+def report_progress(event):
+    '''Send a progress event to the parent process, when running inside
+    edit_sysroot() or a sandbox session. Does nothing otherwise.
+    '''
+    if _channel is not None:
+        _channel.send(ResultChannel.PROGRESS, event)
+
+def _run_child(setup: Callable, fns: list[Callable], on_progress: Callable = None):
+    '''Fork, then run setup and each function in turn in the child.
+    Results are yielded in the parent as they arrive, exceptions are raised
+    again, and progress events are passed to on_progress.
+    If tracing is enabled, the child's spans are sent along with each result.
+    '''
+    global _channel
+
     r_fd, w_fd = os.pipe()
     child = os.fork()
-    if child > 0:
-        os.close(w_fd)
-        pid, ret = os.waitpid(child, 0)
-        return ret, os.read(r_fd, 1024).decode()
+    if child == 0:
+        os.close(r_fd)
+        ret = 1
+        tracer = get_tracer()
+        try:
+            _channel = ResultChannel(w_fd, 'wb')
+            if tracer is not None:
+                tracer.forked()
+            with span('sandbox.setup', setup=getattr(setup, '__name__', '')):
+                setup()
+            for fn in fns:
+                try:
+                    with span('sandbox.call', fn=getattr(fn, '__name__', '')):
+                        res = fn()
+                    kind = ResultChannel.RESULT
+                except Exception as e:
+                    res, kind = e, ResultChannel.ERROR
+                if tracer is not None:
+                    _channel.send(ResultChannel.SPANS, tracer.take())
+                _channel.send(kind, res)
+            ret = 0
+        except BrokenPipeError:
+            ret = 0     # The parent stopped reading, such as after a veto
+        except:
+            error(f"Child process failed: {sys.exc_info()[1]}")
+        finally:
+            os._exit(ret)
+
+    os.close(w_fd)
+    chan = ResultChannel(r_fd, 'rb')
+    count = 0
+    try:
+        for kind, payload in chan.frames():
+            if kind == ResultChannel.PROGRESS:
+                if on_progress is not None:
+                    on_progress(payload)
+                else:
+                    debug(f"{payload}")
+                continue
+            if kind == ResultChannel.SPANS:
+                if get_tracer() is not None:
+                    get_tracer().merge(payload)
+                continue
+            count += 1
+            if kind == ResultChannel.ERROR:
+                raise payload
+            yield payload
+    finally:
+        chan.close()
+        os.waitpid(child, 0)
+    if count < len(fns):
+        raise OSError(f"Child process exited after {count} of {len(fns)} calls")
+
+
+def _enter_sysroot():
+    os.unshare(os.CLONE_NEWNS|os.CLONE_NEWPID)
+    if os.getcwd() != '/':
+        os.chroot(os.getcwd())
+    if libc.mount(b"", str(Path('/','sysroot')).encode(), b"", MS_REMOUNT|MS_BIND, b""):
+        error(f"mount(/sysroot): {os.strerror(get_errno())}")
+        raise OSError(get_errno())
+
+def edit_sysroot(fn: Callable, on_progress: Callable = None):
+    '''Run a process in the bare root with read/write access.
+    Useful for working on an OSTree deployment root.
+    Requires root privileges. Returns the return value of fn, which is
+    conventionally a (ret, value) tuple.
+    '''
+    res, = _run_child(_enter_sysroot, [fn], on_progress)
+    return res
+
+def give_to_sandbox(*paths):
+    '''Let the sandbox user, which is root within a sandbox, own the given
+    paths. Does nothing unless running as root, as sandboxes then run as
+    the current user.
+    '''
+    if os.getuid() != 0:
+        return
+    boxuser = pwd.getpwnam(SANDBOX_USER)
+    for path in paths:
+        os.chown(path, boxuser.pw_uid, boxuser.pw_gid)
+
+def _enter_sandbox(layers: list[Path], upper: Path = None, work: Path = None,
+                   binds: dict[Path,Path] = None):
+    '''Turn a freshly forked child into a layered set sandbox: discard root
+    privileges, enter new namespaces and chroot into the merged layers.
+    '''
+    myuser = os.getuid()
+    mygroup = os.getgid()
+    if myuser == 0:
+        boxuser = pwd.getpwnam(SANDBOX_USER)
+        # Groups first, as they cannot be changed once root is dropped
+        os.setgroups([])
+        os.setgid(boxuser.pw_gid)
+        os.setuid(boxuser.pw_uid)
+        myuser = boxuser.pw_uid
+        mygroup = boxuser.pw_gid
+    os.unshare(os.CLONE_NEWUSER)
+
+    with open("/proc/self/setgroups", "w") as sg:
+        sg.write("deny")
+
+    umap = open("/proc/self/uid_map", "w")
+    gmap = open("/proc/self/gid_map", "w")
+
+    umap.write(f"0 {myuser} 1")
+    gmap.write(f"0 {mygroup} 1")
+
+    umap.close()
+    gmap.close()
+
+    os.unshare(os.CLONE_NEWNS|os.CLONE_NEWPID)
+
+    tgt = mkdtemp(prefix="ostree-sysext-")
+    lower = reduce(lambda l, r: f"{str(l)}:{str(r)}", layers)
+    opt = ""
+    if (upper is None) and (work is None):
+        opt = f"lowerdir={lower},userxattr"
     else:
-        os.unshare(os.CLONE_NEWNS|os.CLONE_NEWPID)
-        if os.getcwd() != '/':
-            os.chroot(os.getcwd())
-        if libc.mount(b"", str(Path('/','sysroot')).encode(), b"", MS_REMOUNT|MS_BIND, b""):
-            error(f"mount(/sysroot): {os.strerror(get_errno())}")
-            exit(2)
+        opt = f"lowerdir={lower},upperdir={str(upper)},workdir={str(work)},userxattr"
+    mount("ostree-sysext", tgt, "overlay", opt)
+    mount("tmpfs", f"{tgt}/run", "tmpfs", "")
+    mount("tmpfs", f"{tgt}/tmp", "tmpfs", "")
 
-        os.close(r_fd)
-        ret, msg = fn()
-        os.write(w_fd, msg.encode())
-        sys.exit(ret)
-    pass
+    if binds is not None:
+        for k, v in binds.items():
+            where = Path(tgt).joinpath(*v.parts[1:])
+            where.mkdir(parents=True, exist_ok=True)
+            if libc.mount(str(k).encode(), str(where).encode(), b"none", MS_BIND, b""):
+                error(f"mount({v}): {os.strerror(get_errno())}")
+                raise OSError(get_errno())
+    os.chroot(tgt)
+    os.chdir('/')
+
+    # we need to be a child of our NEWPID ns to mount /proc
+    mt = os.fork()
+    if mt > 0:
+        pid, status = os.waitpid(mt, 0)
+        os._exit(os.waitstatus_to_exitcode(status))
+    mount("proc", "/proc", "proc", "")
+
+def sandbox_session(fns: list[Callable], layers: list[Path], \
+                    upper: Path = None, work: Path = None, binds: dict[Path,Path] = None,
+                    on_progress: Callable = None):
+    '''Run a sequence of functions in a single layered set sandbox.
+    The sandbox is only set up once, and the return value of each function
+    is yielded as soon as it completes. Exceptions raised by a function are
+    raised again in the caller.
+    '''
+    if len(fns) == 0:
+        return
+    yield from _run_child(lambda: _enter_sandbox(layers, upper, work, binds),
+                          fns, on_progress)
 
 def edit_sandbox(fn: Callable, layers: list[Path], \
-                 upper: Path = None, work: Path = None, binds: dict[Path,Path] = None) \
-        -> tuple[int, str]:
+                 upper: Path = None, work: Path = None, binds: dict[Path,Path] = None,
+                 on_progress: Callable = None):
     '''Run a process in the given layered set sandbox.
     Useful for building or editing a sysext.
-    Will discard root privileges.
+    Will discard root privileges. Returns the return value of fn.
     '''
-    r_fd, w_fd = os.pipe()
-    child = os.fork()
-    if child > 0:
-        os.close(w_fd)
-        pid, ret = os.waitpid(child, 0)
-        return ret, os.read(r_fd, 1024).decode()
-    else:
-        myuser = os.getuid()
-        if myuser == 0:
-            boxuser = pwd.getpwnam("ostree-sysext")
-            os.setuid(boxuser)
-            myuser = boxuser
-        os.unshare(os.CLONE_NEWUSER)
-
-        with open("/proc/self/setgroups", "w") as sg:
-            sg.write("deny")
-
-        umap = open("/proc/self/uid_map", "w")
-        gmap = open("/proc/self/gid_map", "w")
-
-        umap.write(f"0 {myuser} 1")
-        gmap.write(f"0 {myuser} 1")
-
-        umap.close()
-        gmap.close()
-
-        os.unshare(os.CLONE_NEWNS|os.CLONE_NEWPID)
-
-        tgt = mkdtemp(prefix="ostree-sysext-")
-        lower = reduce(lambda l, r: f"{str(l)}:{str(r)}", layers)
-        opt = ""
-        if (upper is None) and (work is None):
-            opt = f"lowerdir={lower},userxattr"
-        else:
-            opt = f"lowerdir={lower},upperdir={str(upper)},workdir={str(work)},userxattr"
-        mount("ostree-sysext", tgt, "overlay", opt)
-        mount("tmpfs", f"{tgt}/run", "tmpfs", "")
-        mount("tmpfs", f"{tgt}/tmp", "tmpfs", "")
-
-        if binds is not None:
-            for k, v in binds.items():
-                where = Path(tgt).joinpath(v.parts[1:])
-                if not where.exists():
-                    where.mkdir()
-                if libc.mount(str(k).encode(), str(where).encode(), b"none", MS_BIND, b""):
-                    error(f"mount({v}): {os.strerror(get_errno())}")
-                    exit(2)
-        os.chroot(tgt)
-
-        # we need to be a child of our NEWPID ns to mount /proc
-        mt = os.fork()
-        if mt > 0:
-            os.waitpid(mt, 0)
-        else:
-            mount("proc", "/proc", "proc", "")
-        os.close(r_fd)
-        ret, msg = fn()
-        write(w_fd, msg)
-        sys.exit(ret)
-
-    pass
+    res, = sandbox_session([fn], layers, upper, work, binds, on_progress)
+    return res
@@ -3,7 +3,10 @@ import subprocess
 import json
 
 from pathlib        import Path
+from dotenv         import dotenv_values
 from .extensions    import Extension
+from .mounts        import invalidate_mount_table
+from .trace         import span
 
 SYSTEMD_SYSEXT_COMMAND = [ 'systemd-sysext', '--json=short' ]
 
@@ -11,7 +14,8 @@ def call_systemd(*args):
     '''Interact with the systemd-sysext command using JSON response
     given a set of arguments
     '''
-    r = subprocess.run(SYSTEMD_SYSEXT_COMMAND + list(args), capture_output=True)
+    with span('systemd-sysext', args=' '.join(args)):
+        r = subprocess.run(SYSTEMD_SYSEXT_COMMAND + list(args), capture_output=True)
     return json.loads(r.stdout)
 
 def check_sysext() -> bool:
@@ -34,5 +38,40 @@ def list_staged() -> dict[str,str]:
     return staged
 
 def refresh_sysexts(*args):
-    subprocess.run(SYSTEMD_SYSEXT_COMMAND + [ "refresh" ] + list(args))
+    with span('systemd-sysext', args=' '.join(("refresh",) + args)):
+        subprocess.run(SYSTEMD_SYSEXT_COMMAND + [ "refresh" ] + list(args))
+    invalidate_system_state()
+    invalidate_mount_table()
+
+
+class SystemState:
+    '''Snapshot of the systemd-sysext state and os-release of the current root.
+    Captured once per invocation, so that evaluating the state of N extensions
+    does not cost N calls to systemd-sysext.
+    '''
+    staged: dict[str,str]
+    deployed: set[str]
+    os_release: dict
+
+    def __init__(self):
+        self.staged = list_staged()
+        self.deployed = set(list_deployed())
+        with open('etc/os-release') as osrf:
+            self.os_release = dotenv_values(stream=osrf)
+
+_system_state: SystemState = None
+
+def get_system_state() -> SystemState:
+    '''Return the current SystemState snapshot, capturing it if needed.
+    '''
+    global _system_state
+    if _system_state is None:
+        _system_state = SystemState()
+    return _system_state
+
+def invalidate_system_state():
+    '''Drop the current SystemState snapshot, after systemd-sysext changed.
+    '''
+    global _system_state
+    _system_state = None
 
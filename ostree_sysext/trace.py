@@ -0,0 +1,152 @@
+import os
+import json
+import functools
+
+from time           import monotonic_ns
+from threading      import local, Lock, get_ident
+from contextlib     import contextmanager, nullcontext
+
+# Lightweight timing spans, disabled unless enable_tracing() was called.
+# Timestamps come from the monotonic clock, which is shared with forked
+# children, so that their spans can be merged into the parent's trace.
+
+
+class Tracer:
+    '''Collects finished spans for this process and the children it forked.
+    Spans opened on a worker thread with no open span of its own are
+    attached to the innermost span of the thread which enabled tracing.
+    '''
+    spans: list[dict]
+    start: int
+
+    def __init__(self):
+        self.spans = []
+        self.start = monotonic_ns()
+        self._main = get_ident()
+        self._stacks = {}
+        self._lock = Lock()
+        self._next = 0
+
+    def _stack(self) -> list:
+        return self._stacks.setdefault(get_ident(), [])
+
+    def _parent(self) -> str:
+        stack = self._stack()
+        if len(stack) == 0:
+            stack = self._stacks.get(self._main, [])
+        return stack[-1] if len(stack) > 0 else None
+
+    @contextmanager
+    def span(self, name: str, **args):
+        with self._lock:
+            self._next += 1
+            id = f'{os.getpid()}.{self._next}'
+        rec = { 'name': name, 'id': id, 'parent': self._parent(), 'args': args,
+                'pid': os.getpid(), 'tid': get_ident(), 'start': monotonic_ns() }
+        stack = self._stack()
+        stack.append(id)
+        try:
+            yield rec
+        finally:
+            rec['end'] = monotonic_ns()
+            stack.pop()
+            with self._lock:
+                self.spans.append(rec)
+
+    def forked(self):
+        '''Forget the parent's spans in a freshly forked child, keeping only
+        the span stack of the forking thread.
+        '''
+        self.spans = []
+        self._stacks = { get_ident(): self._stack() }
+        self._main = get_ident()
+        self._lock = Lock()
+
+    def take(self) -> list[dict]:
+        '''Return and forget the spans finished so far.
+        '''
+        with self._lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+    def merge(self, spans: list[dict]):
+        '''Add spans reported by a child process.
+        '''
+        with self._lock:
+            self.spans += spans
+
+    def tree(self) -> str:
+        '''Render spans as an indented tree, where sibling spans of the
+        same name are added up.
+        '''
+        children = {}
+        for rec in sorted(self.spans, key=lambda r: r['start']):
+            children.setdefault(rec['parent'], []).append(rec)
+
+        lines = []
+        def walk(parent_ids: list, depth: int):
+            phases = {}
+            for pid in parent_ids:
+                for rec in children.get(pid, []):
+                    ph = phases.setdefault(rec['name'], [0, 0, []])
+                    ph[0] += 1
+                    ph[1] += rec['end'] - rec['start']
+                    ph[2].append(rec['id'])
+            for name, (count, total, ids) in phases.items():
+                label = f"{'  ' * depth}{name}"
+                times = f" x{count}" if count > 1 else ""
+                lines.append(f"{label:<48} {total / 1e9:9.3f}s{times}")
+                walk(ids, depth + 1)
+
+        known = set(rec['id'] for rec in self.spans)
+        roots = set(rec['parent'] for rec in self.spans if rec['parent'] not in known)
+        walk(list(roots), 0)
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        '''Return the spans in the Chrome trace event format.
+        '''
+        return { 'traceEvents': [
+            { 'name': rec['name'], 'ph': 'X', 'pid': rec['pid'], 'tid': rec['tid'],
+              'ts':   (rec['start'] - self.start) / 1e3,
+              'dur':  (rec['end'] - rec['start']) / 1e3,
+              'args': { k: str(v) for k, v in rec['args'].items() } }
+            for rec in self.spans ] }
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+_tracer: Tracer = None
+
+def enable_tracing() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+def get_tracer() -> Tracer:
+    '''Return the active Tracer, or None if tracing is disabled.
+    '''
+    return _tracer
+
+def span(name: str, **args):
+    '''Context manager timing the enclosed block, if tracing is enabled.
+    '''
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.span(name, **args)
+
+def traced(name: str):
+    '''Decorator timing every call to a function, if tracing is enabled.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            with _tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,142 @@
+import json
+import threading
+
+from logging                import warn, error, debug
+from gi.repository          import OSTree
+from concurrent.futures     import ThreadPoolExecutor
+
+from .extensions            import CompatVote, UpdateState
+from .builder               import has_batch_hooks, build_extensions, find_builder, \
+                                   check_updates as check_updates_with, BUILDERS_PATH
+from .repo                  import RepoExtension, SysrootTransaction, extension_ref
+
+# Number of builders checking for updates concurrently
+UPDATE_JOBS = 4
+# Seconds after which a builder's update check is considered UNKNOWN
+UPDATE_TIMEOUT = 120
+
+
+class UpgradeReport:
+    '''Aggregated result of an upgrade run.
+    Extensions sharing a builder and build context are checked and built
+    once, and share the same entry.
+    '''
+    checks: dict[str, tuple[UpdateState, str]]
+    builds: dict[str, tuple[CompatVote, str]]
+
+    def __init__(self):
+        self.checks = {}
+        self.builds = {}
+
+    def available(self) -> list[str]:
+        return [id for id, (res, msg) in self.checks.items() if res == UpdateState.AVAIL]
+
+    def __str__(self):
+        counts = {}
+        for res, msg in self.checks.values():
+            counts[res.name.lower()] = counts.get(res.name.lower(), 0) + 1
+        built = len([r for r, m in self.builds.values() if r == CompatVote.APPROVE])
+        return ", ".join(f"{n} {k}" for k, n in counts.items()) + f", {built} built"
+
+
+def _group_by_context(exts: list[RepoExtension]) -> dict[tuple[str, str], list[RepoExtension]]:
+    groups = {}
+    for ext in exts:
+        if ext.builder is None:
+            continue    # Not built locally, nothing to check
+        key = (ext.builder, json.dumps(ext.build_context, sort_keys=True))
+        groups.setdefault(key, []).append(ext)
+    return groups
+
+def _by_builder(groups: dict) -> dict[str, list[tuple[str, str]]]:
+    builders = {}
+    for key in groups.keys():
+        builders.setdefault(key[0], []).append(key)
+    return builders
+
+def _check_with_timeout(mod, root: OSTree.Deployment, exts: list[RepoExtension],
+                        force: bool, timeout: float) -> list[tuple[UpdateState, str]]:
+    '''Check a batch of extensions from one builder module, giving up after
+    timeout seconds. A builder which is too slow is left running, but no
+    longer blocks the batch.
+    '''
+    builder = mod.__name__
+    result = []
+
+    def run():
+        try:
+            result.append(check_updates_with(mod, root, exts, force))
+        except Exception as e:
+            result.append([(UpdateState.UNKNOWN, f"{builder}: {e}")] * len(exts))
+
+    th = threading.Thread(target=run, daemon=True)
+    th.start()
+    th.join(timeout)
+    if len(result) == 0:
+        return [(UpdateState.UNKNOWN, f"{builder}: timed out after {timeout}s")] * len(exts)
+    return result[0]
+
+def check_updates(root: OSTree.Deployment, exts: list[RepoExtension], force=False,
+                  jobs: int = UPDATE_JOBS, timeout: float = UPDATE_TIMEOUT) -> UpgradeReport:
+    '''Check all locally-built extensions for updates concurrently.
+    Identical (builder, build context) pairs are only checked once, and
+    builders with batch hooks get all of their pairs in a single call.
+    Builders are imported up front, as worker threads must not import.
+    '''
+    report = UpgradeReport()
+    groups = _group_by_context(exts)
+    batches = []
+    for builder, keys in _by_builder(groups).items():
+        try:
+            mod = find_builder(BUILDERS_PATH, builder)
+        except (ImportError, ValueError) as e:
+            for key in keys:
+                for ext in groups[key]:
+                    report.checks[ext.get_id()] = (UpdateState.UNKNOWN, f"{builder}: {e}")
+            continue
+        if has_batch_hooks(mod):
+            batches.append((mod, keys))
+        else:
+            batches += [(mod, [key]) for key in keys]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [ (keys, pool.submit(_check_with_timeout, mod, root,
+                                       [groups[key][0] for key in keys], force, timeout))
+                    for mod, keys in batches ]
+        for keys, fut in futures:
+            for key, res in zip(keys, fut.result()):
+                for ext in groups[key]:
+                    report.checks[ext.get_id()] = res
+    return report
+
+def upgrade(repo: OSTree.Repo, root: OSTree.Deployment, exts: list[RepoExtension],
+            force=False, jobs: int = UPDATE_JOBS, timeout: float = UPDATE_TIMEOUT,
+            check_only=False) -> UpgradeReport:
+    '''Check all extensions for updates, then build and pin those which
+    reported one available, one batch per builder.
+    '''
+    report = check_updates(root, exts, force, jobs, timeout)
+    if check_only:
+        return report
+
+    groups = _group_by_context(exts)
+    avail = report.available()
+    tx = SysrootTransaction(repo)
+    for builder, keys in _by_builder(groups).items():
+        keys = [key for key in keys if groups[key][0].get_id() in avail]
+        if len(keys) == 0:
+            continue
+        try:
+            mod = find_builder(BUILDERS_PATH, builder)
+            results = build_extensions(repo, mod, root, [json.loads(key[1]) for key in keys], force)
+        except Exception as e:
+            results = [(CompatVote.VETO, f"{builder}: {e}")] * len(keys)
+        for key, (res, msg) in zip(keys, results):
+            for ext in groups[key]:
+                report.builds[ext.get_id()] = (res, msg)
+                if res == CompatVote.APPROVE:
+                    tx.set_ref(extension_ref(ext.get_id()), msg)
+                else:
+                    error(f"Could not build extension '{ext.get_id()}': {msg}")
+    tx.run()
+    return report
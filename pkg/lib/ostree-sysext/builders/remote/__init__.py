@@ -2,17 +2,89 @@ import gi
 
 gi.require_version("OSTree", "1.0")
 
-from gi.repository            import OSTree
-from ostree_sysext.extensions import Extension, CompatVote
+from gi.repository            import OSTree, GLib, Gio
+from ostree_sysext.extensions import Extension, CompatVote, UpdateState
+
+SYSTEM_REPO = '/ostree/repo'
+
+# Refs advertised by each remote's summary, fetched once per remote per run
+_remote_refs: dict[str, dict[str, str]] = {}
+
+
+def open_repo(path: str = SYSTEM_REPO) -> OSTree.Repo:
+    repo = OSTree.Repo.new(Gio.File.new_for_path(path))
+    repo.open()
+    return repo
+
+def parse_context(context: dict) -> tuple[str, str]:
+    '''Split the 'remote_ref' context key into a remote and a ref.
+    '''
+    ok, remote, ref = OSTree.parse_refspec(context['remote_ref'])
+    if remote is None:
+        raise ValueError(f"'{context['remote_ref']}' does not name a remote")
+    return remote, ref
+
+def remote_refs(repo: OSTree.Repo, remote: str) -> dict[str, str]:
+    '''Return the refs advertised by a remote and their commit checksums.
+    The summary file is only fetched the first time a remote is queried.
+    '''
+    if remote not in _remote_refs:
+        ok, refs = repo.remote_list_refs(remote, None)
+        _remote_refs[remote] = refs
+    return _remote_refs[remote]
+
+def check_refs(repo: OSTree.Repo, remote: str, local: dict[str, str]) \
+        -> dict[str, tuple[UpdateState, str]]:
+    '''Compare local commits for the given refs against a remote's summary.
+    '''
+    refs = remote_refs(repo, remote)
+    res = {}
+    for ref, commit in local.items():
+        if ref not in refs:
+            res[ref] = (UpdateState.UNKNOWN, f"'{ref}' not found on remote '{remote}'")
+        elif refs[ref] == commit:
+            res[ref] = (UpdateState.UNAVAIL, "")
+        else:
+            res[ref] = (UpdateState.AVAIL, f"{commit[:10]} -> {refs[ref][:10]}")
+    return res
+
+def check_updates(root: OSTree.Deployment, exts: list[Extension], contexts: list[dict]) \
+        -> list[tuple[UpdateState, str]]:
+    '''Check that remote refs have new commits, for a batch of extensions.
+    '''
+    repo = open_repo()
+    specs = [parse_context(ctx) for ctx in contexts]
+    by_remote = {}
+    for (remote, ref), ext in zip(specs, exts):
+        by_remote.setdefault(remote, {})[ref] = ext.commit
+
+    res = {}
+    for remote, local in by_remote.items():
+        try:
+            for ref, verdict in check_refs(repo, remote, local).items():
+                res[(remote, ref)] = verdict
+        except GLib.Error as e:
+            for ref in local.keys():
+                res[(remote, ref)] = (UpdateState.UNKNOWN, e.message)
+    return [res[spec] for spec in specs]
+
+def build_extensions(root: OSTree.Deployment, contexts: list[dict]) -> list[tuple[str, str]]:
+    '''Name the remote and ref to pull for each context of a batch.
+    ostree-sysext pulls them outside of the sandbox, with a single pull per
+    remote.
+    '''
+    return [parse_context(ctx) for ctx in contexts]
 
 
 def check_update(root: OSTree.Deployment, ext: Extension, context: dict):
     '''Check that remote ref has new commits.
     '''
-    pass
+    return check_updates(root, [ext], [context])[0]
 
 def build_extension(root: OSTree.Deployment, context: dict):
-    '''This builder takes a single context key, 'remote_ref',
-    and pulls from the given OSTree remote.
+    '''This builder takes a single context key, 'remote_ref', naming the
+    OSTree remote to pull from. Pulls write to the system repository, so
+    they are only done through build_extensions().
     '''
-    pass
+    return CompatVote.VETO, f"'{context['remote_ref']}' can only be pulled in a batch"
+
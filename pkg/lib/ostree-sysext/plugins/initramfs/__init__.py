@@ -1,9 +1,77 @@
 import gi
+import shutil
+import subprocess
 
 gi.require_version("OSTree", "1.0")
 
-from gi.repository            import OSTree
+from gi.repository            import OSTree, Gio, GLib
+from hashlib                  import sha256
+from pathlib                  import Path
+from tempfile                 import mkdtemp
 from ostree_sysext.extensions import Extension, CompatVote
+from ostree_sysext.plugin     import hash_tree
+
+__version__ = '2'
+
+SYSTEM_REPO = '/sysroot/ostree/repo'
+WORK_PATH = Path('/', 'run', 'ostree', 'extensions')
+STATE_PATH = WORK_PATH.joinpath('state', 'initramfs')
+
+# Trees which make up the initramfs. /etc is stored as usr/etc in commits.
+INPUTS = [ 'usr/lib/modules', 'usr/lib/firmware', 'usr/lib/dracut', 'usr/etc/dracut.conf.d' ]
+# Local configuration of the deployment, which is part of the set key
+STATE_INPUTS = [ 'etc/dracut.conf.d' ]
+
+
+def _open_repo() -> OSTree.Repo:
+    repo = OSTree.Repo.new(Gio.File.new_for_path(SYSTEM_REPO))
+    repo.open()
+    return repo
+
+def _tree_checksum(tree: OSTree.RepoFile, path: str) -> str:
+    '''Identify a directory of a commit by its dirtree and dirmeta checksums,
+    without reading any file.
+    '''
+    sub = tree.resolve_relative_path(path)
+    if sub.query_file_type(Gio.FileQueryInfoFlags.NONE, None) != Gio.FileType.DIRECTORY:
+        return "absent"
+    sub.ensure_resolved()
+    return f"{sub.tree_get_contents_checksum()}:{sub.tree_get_metadata_checksum()}"
+
+def fingerprint(repo: OSTree.Repo, root: OSTree.Deployment, exts: list[Extension]) -> str:
+    '''Fingerprint the initramfs inputs across the base and all extensions,
+    in stacking order. Layers which provide none of them are left out, so
+    that extensions unrelated to the initramfs do not change it.
+    '''
+    h = sha256()
+    for commit in [root.get_csum()] + [ext.commit for ext in exts]:
+        tree = repo.read_commit(commit).out_root
+        sums = [f"{path}={_tree_checksum(tree, path)}" for path in INPUTS]
+        if all(s.endswith("=absent") for s in sums):
+            continue
+        h.update(("\n".join(sums) + "\n\n").encode())
+    for path in STATE_INPUTS:
+        h.update(f"/{path}={hash_tree(Path('/', path))}\n".encode())
+    return h.hexdigest()
+
+def parent_fingerprint(repo: OSTree.Repo) -> str:
+    '''Read the fingerprint recorded by the set this one is committed on
+    top of, whose state is carried over if we do not write any.
+    '''
+    try:
+        parent = WORK_PATH.joinpath('parent').read_text().strip()
+        tree = repo.read_commit(parent).out_root
+        fp = tree.resolve_relative_path('state/initramfs/fingerprint')
+        return fp.load_contents(None).contents.decode().strip()
+    except (OSError, GLib.Error):
+        return None
+
+def _kernel_version() -> str:
+    kvers = [k.name for k in Path('/', 'usr', 'lib', 'modules').iterdir()
+             if k.joinpath('vmlinuz').exists()]
+    if len(kvers) != 1:
+        raise ValueError(f"Expected a single kernel in /usr/lib/modules, found {len(kvers)}")
+    return kvers[0]
 
 
 def check_compatible(root: OSTree.Deployment, exts: list[Extension]) \
@@ -14,5 +82,31 @@ def check_compatible(root: OSTree.Deployment, exts: list[Extension]) \
 
 def deploy_finish(root: OSTree.Deployment, exts: list[Extension]) \
         -> tuple[CompatVote, str]:
-    '''Generate initramfs from the complete stack of extensions'''
-    pass
+    '''Generate initramfs from the complete stack of extensions.
+    If none of its inputs changed since the previous set, nothing is written,
+    so that the previous set's initramfs is carried over.
+    '''
+    repo = _open_repo()
+    fp = fingerprint(repo, root, exts)
+    if fp == parent_fingerprint(repo):
+        return CompatVote.APPROVE, ""
+
+    # Build next to the state tree, so that a failed build leaves the
+    # previous initramfs in place
+    build = None
+    try:
+        kver = _kernel_version()
+        build = Path(mkdtemp(prefix='.initramfs-', dir=WORK_PATH))
+        r = subprocess.run([ 'dracut', '--force', '--kver', kver,
+                             str(build.joinpath(f'initramfs-{kver}.img')) ],
+                           capture_output=True)
+        if r.returncode != 0:
+            return CompatVote.WARN, f"dracut failed: {r.stderr.decode().strip()}"
+        build.joinpath('fingerprint').write_text(f"{fp}\n")
+        build.rename(STATE_PATH)
+    except (OSError, ValueError) as e:
+        return CompatVote.WARN, f"Cannot regenerate initramfs: {e}"
+    finally:
+        if build is not None:
+            shutil.rmtree(build, ignore_errors=True)
+    return CompatVote.APPROVE, ""